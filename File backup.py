@@ -1,26 +1,3779 @@
 ﻿import os
+import sys
 import time
+import signal
+import select
+import errno
+import argparse
 import threading
-import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext, ttk
-from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
-import fnmatch
+from datetime import datetime
+import zipfile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP_BZIP2, ZIP_LZMA, ZIP64_LIMIT
 import json
+import sqlite3
+import struct
+import ctypes
+import platform
 import logging
-from queue import Queue, Empty
-import pystray
-from PIL import Image, ImageDraw
+import logging.handlers
+import hashlib
+import re
+import zlib
+import bz2
+import math
+import heapq
+import itertools
+import random
+import string
+import subprocess
+import tempfile
+import copy
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty, Full
 import shutil  # для проверки свободного места
+try:
+    import fcntl  # клонирование файлов (reflink) в снимках; нет в Windows
+except ImportError:
+    fcntl = None
+try:
+    import resource  # пиковая память дочернего процесса в замере производительности; нет в Windows
+except ImportError:
+    resource = None
 
 SETTINGS_FILE = "backup_app_settings.json"
 SETTINGS_BACKUP_FILE = "backup_app_settings_backup.json"
 LOG_FILE = "backup_app.log"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Окно лога показывает только последние строки; полный лог - в файле
+LOG_WIDGET_MAX_LINES = 2000
+# Сколько сообщений интерфейс забирает из очереди за один такт
+LOG_BATCH_SIZE = 2000
+# "debug" дополнительно пишет сообщения по каждому файлу
+LOG_LEVELS = {"info": logging.INFO, "debug": logging.DEBUG}
+# Период опроса хода резервного копирования окном, мс
+PROGRESS_POLL_MS = 250
+# Период вывода хода работы в консольном режиме, с
+CONSOLE_PROGRESS_INTERVAL = 1
 
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# Служебные данные задания хранятся в целевом каталоге
+STATE_DIR_NAME = ".backup_state"
+MANIFEST_FILE = "manifest.json"
+LAST_RUN_FILE = "last_run.json"
+CATALOG_FILE = "catalog.db"
+SCRUB_STATE_FILE = "scrub.json"
+CHECKPOINT_FILE = "checkpoint.json"
+# История итогов запусков, по строке JSON на запуск; при превышении размера остаётся вторая половина
+RUNS_HISTORY_FILE = "runs.jsonl"
+RUNS_HISTORY_MAX_BYTES = 2 * 1024 * 1024
+# Степени сжатия по расширениям, накопленные за прошлые запуски, для предварительной оценки
+RATIOS_FILE = "ratios.json"
+# Предварительная оценка по выборке: в каждом каталоге читаются атрибуты не более PREFLIGHT_DIR_SAMPLE
+# файлов, каталоги обходятся в случайном порядке не дольше PREFLIGHT_MAX_SECONDS; для расширений
+# без истории - проба сжатия начала нескольких файлов
+PREFLIGHT_MAX_SECONDS = 10
+PREFLIGHT_DIR_SAMPLE = 16
+PREFLIGHT_SAMPLE_FILES = 3
+PREFLIGHT_SAMPLE_BYTES = 256 * 1024
+# Оценка того, сколько zip добавляет к каждой записи (заголовки и центральный каталог без имени файла)
+ZIP_ENTRY_OVERHEAD = 100
+# off - без оценки, warn - предупредить, refuse - не начинать запуск, если копия не поместится
+PREFLIGHT_POLICIES = {
+    "off": "Не оценивать",
+    "warn": "Предупреждать",
+    "refuse": "Не запускать",
+}
+# Архив пишется под этим суффиксом и получает своё имя только после успешного завершения
+PARTIAL_SUFFIX = ".partial"
+# Как часто прогресс записи фиксируется в контрольной точке, с
+CHECKPOINT_INTERVAL = 60
+# Суффикс архива, не прошедшего проверку после записи
+CORRUPT_SUFFIX = ".corrupt"
+ARCHIVE_META_NAME = "__backup__.json"
+# Повторы содержимого в одном архиве: {путь повтора: путь записанной копии}
+ARCHIVE_REFS_NAME = "__refs__.json"
+# Большой файл, изменившийся с прошлой копии, хранится записью "<путь>.bkdelta" только с изменёнными блоками
+DELTA_SUFFIX = ".bkdelta"
+DELTA_MAGIC = b"BKDELTA1"
+# Заголовок дельты: размер новой версии, размер блока, число блоков; перед каждым блоком - его номер
+DELTA_HEADER = struct.Struct("<QQQ")
+DELTA_BLOCK_INDEX = struct.Struct("<Q")
+# Подписи блоков последней записанной версии больших файлов
+SIGNATURES_DIR_NAME = "signatures"
+# Файл правил исключения в корне каталога-источника (синтаксис .gitignore)
+IGNORE_FILE_NAME = ".backupignore"
 
+REPOSITORY_DIR_NAME = "repository"
+# Снимки-деревья режима "snapshot": <цель>/snapshots/YYYYMMDD-HHMMSS/
+LINK_SNAPSHOTS_DIR_NAME = "snapshots"
+# ioctl FICLONE из linux/fs.h: копия делит блоки с оригиналом до первой записи (Btrfs, XFS)
+FICLONE = 0x40049409
 
-class BackupApp:
+BACKUP_MODES = {
+    "full": "Полный",
+    "incremental": "Инкрементальный",
+    "repository": "Репозиторий (дедупликация)",
+    "snapshot": "Снимки (жёсткие ссылки)",
+}
+
+COPY_BLOCK_SIZE = 1024 * 1024
+# Сжатые данные файла держим в памяти до этого размера, дальше - во временном файле
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+# Сколько сжатых записей в памяти может ждать, пока их допишут все цели; сверх этого основной поток ждёт,
+# иначе отстающая цель держала бы в памяти по очереди записей на каждую цель
+FANOUT_MAX_MEMORY = 32 * 1024 * 1024
+
+# Кодеки сжатия записей архива
+CODEC_TYPES = {
+    "store": ZIP_STORED,
+    "deflate": ZIP_DEFLATED,
+    "bzip2": ZIP_BZIP2,
+    "lzma": ZIP_LZMA,
+}
+# Уже сжатые форматы: повторное сжатие только тратит процессор
+DEFAULT_CODEC_RULES = {ext: "store" for ext in (
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".lz4", ".cab",
+    ".mp3", ".aac", ".ogg", ".flac", ".m4a", ".mp4", ".m4v", ".mkv", ".avi", ".mov", ".webm",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".jar", ".apk", ".msi",
+)}
+ENTROPY_PROBE_SIZE = 64 * 1024
+# Выше этой энтропии (бит на байт) данные считаются несжимаемыми
+ENTROPY_STORE_THRESHOLD = 7.5
+
+# Пауза перед повторным чтением файла, изменившегося во время чтения; удваивается с каждой попыткой, с
+CONSISTENCY_RETRY_DELAY = 0.5
+
+# Сколько найденных файлов сканер может опережать архиватор
+SCAN_QUEUE_SIZE = 10000
+
+# Номер системного вызова ioprio_set в Linux для разных архитектур
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# Параметры разбиения на блоки по содержимому (content-defined chunking): кандидат в границы -
+# место, где биты последних CDC_ANCHOR_BITS байт совпали с якорем, граница - кандидат, у которого
+# ещё CDC_CHECK_BITS бит CRC32 последних CDC_WINDOW байт нулевые
+CDC_MIN_SIZE = 256 * 1024
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CDC_ANCHOR_BITS = 10
+CDC_CHECK_BITS = 10  # вместе с якорем средний размер блока около CDC_MIN_SIZE + 1 МБ
+CDC_WINDOW = 48
+
+# Сценарии замера производительности: число файлов (умножается на масштаб), размеры,
+# глубина и ветвление дерева, данные: text - сжимаемые, random - несжимаемые, mixed - через один
+BENCH_SCENARIOS = {
+    "tiny_files": {"files": 20000, "min_size": 0, "max_size": 4096, "depth": 2, "fanout": 30, "data": "text"},
+    "huge_files": {"files": 2, "min_size": 64 * 1024 * 1024, "max_size": 64 * 1024 * 1024,
+                   "depth": 0, "fanout": 1, "data": "mixed"},
+    "deep_nesting": {"files": 2000, "min_size": 512, "max_size": 8192, "depth": 30, "fanout": 2, "data": "text"},
+    "compressible": {"files": 200, "min_size": 1024 * 1024, "max_size": 1024 * 1024,
+                     "depth": 1, "fanout": 10, "data": "text"},
+    "random": {"files": 200, "min_size": 1024 * 1024, "max_size": 1024 * 1024,
+               "depth": 1, "fanout": 10, "data": "random"},
+}
+BENCH_SEED = 1
+BENCH_SPEC_FILE = ".bench_spec.json"
+# Самопроверка ограничения скорости (--check-throttle): длительность чтения при лимите и допустимое отклонение
+THROTTLE_CHECK_SECONDS = 4
+THROTTLE_CHECK_TOLERANCE = 0.15
+
+# События inotify, см. <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                      | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+INOTIFY_EVENT = struct.Struct("iIII")
+# Чаще этого изменения в архивы не сбрасываются, с
+WATCH_MIN_FLUSH_SECONDS = 5
+
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s',
+                    handlers=[logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                                                   backupCount=LOG_BACKUP_COUNT,
+                                                                   encoding="utf-8")])
+
+# Модули интерфейса загружаются только в оконном режиме, консольный режим обходится без них
+tk = filedialog = messagebox = scrolledtext = simpledialog = ttk = None
+pystray = Image = ImageDraw = None
+
+
+def _import_ui_modules():
+    global tk, filedialog, messagebox, scrolledtext, simpledialog, ttk, pystray, Image, ImageDraw
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, scrolledtext, simpledialog, ttk
+    import pystray
+    from PIL import Image, ImageDraw
+
+
+def _file_digest(path, block_size=1024 * 1024, throttle=None):
+    h = hashlib.sha256()
+    with (throttle.open(path) if throttle else open(path, "rb")) as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_json_atomic(path, data):
+    # Пишем во временный файл и подменяем, чтобы не оставить битый JSON при сбое
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _list_archives(target_dir, suffix=""):
+    # Архивы вида YYYYMMDD/HHMMSS.zip (с суффиксом - недописанные) в хронологическом порядке
+    archives = []
+    if not os.path.isdir(target_dir):
+        return archives
+    for date_folder in sorted(os.listdir(target_dir)):
+        folder = os.path.join(target_dir, date_folder)
+        if not re.fullmatch(r"\d{8}", date_folder) or not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if re.fullmatch(r"\d{6}\.zip" + re.escape(suffix), name):
+                archives.append(os.path.join(folder, name))
+    return archives
+
+
+def _gfs_keep(timestamps, daily, weekly, monthly):
+    # Схема "дед-отец-сын": самая свежая копия за каждый из последних дней, недель и месяцев
+    keep = set()
+    order = sorted(range(len(timestamps)), key=lambda i: timestamps[i], reverse=True)
+    if order:
+        keep.add(order[0])
+    for count, bucket_of in ((daily, lambda d: d.date()),
+                             (weekly, lambda d: d.isocalendar()[:2]),
+                             (monthly, lambda d: (d.year, d.month))):
+        seen = set()
+        for i in order:
+            if len(seen) >= count:
+                break
+            bucket = bucket_of(timestamps[i])
+            if bucket not in seen:
+                seen.add(bucket)
+                keep.add(i)
+    return keep
+
+
+class RateLimiter:
+    """Ограничитель скорости в байтах в секунду (0 - без ограничения), общий для всех потоков.
+
+    Считает, когда закончится передача уже разрешённых байтов, и усыпляет
+    вызывающий поток до этого момента; запас в burst секунд сглаживает рывки.
+    """
+
+    def __init__(self, rate=0, burst=0.25):
+        self.rate = rate
+        self.burst = burst
+        self.bytes_total = 0
+        self.started = time.monotonic()
+        self._next_free = self.started
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            self.bytes_total += size
+            if self.rate <= 0:
+                return
+            now = time.monotonic()
+            self._next_free = max(self._next_free, now - self.burst) + size / self.rate
+            delay = self._next_free - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def achieved_rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.bytes_total / elapsed if elapsed > 0 else 0.0
+
+
+class _ThrottledFile:
+    def __init__(self, f, throttle):
+        self._f = f
+        self._throttle = throttle
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._throttle.limiter.consume(len(data))
+        if self._throttle.shared_limiter:
+            self._throttle.shared_limiter.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        try:
+            self._f.close()
+        finally:
+            self._throttle.handles.release()
+
+
+class _NoLimit:
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class Throttle:
+    """Ограничения, чтобы резервное копирование не мешало рабочей нагрузке.
+
+    Скорость чтения (в том числе по расписанию времени суток), число
+    одновременно открытых файлов и пониженный приоритет CPU/ввода-вывода
+    потоков резервного копирования в Linux.
+    """
+
+    def __init__(self, read_limit_mbps=0, schedule=None, max_open_files=0, low_priority=False, shared_limiter=None):
+        self.read_limit_mbps = read_limit_mbps
+        self.schedule = schedule or []
+        self.low_priority = low_priority
+        self.limiter = RateLimiter(self._scheduled_rate())
+        # Общий для всех заданий планировщика лимит чтения
+        self.shared_limiter = shared_limiter
+        self.handles = threading.BoundedSemaphore(max_open_files) if max_open_files > 0 else _NoLimit()
+        self._rate_checked = time.monotonic()
+
+    def _scheduled_rate(self):
+        # Окна вида {"start": "08:00", "end": "19:00", "read_mbps": 20}, окно может переходить через полночь
+        now = time.localtime()
+        minutes = now.tm_hour * 60 + now.tm_min
+        for window in self.schedule:
+            start_h, start_m = (int(x) for x in window["start"].split(":"))
+            end_h, end_m = (int(x) for x in window["end"].split(":"))
+            start, end = start_h * 60 + start_m, end_h * 60 + end_m
+            inside = start <= minutes < end if start <= end else (minutes >= start or minutes < end)
+            if inside:
+                return window.get("read_mbps", 0) * 1024 * 1024
+        return self.read_limit_mbps * 1024 * 1024
+
+    def open(self, path):
+        if time.monotonic() - self._rate_checked > 1:
+            self._rate_checked = time.monotonic()
+            self.limiter.rate = self._scheduled_rate()
+        self.handles.acquire()
+        try:
+            return _ThrottledFile(open(path, "rb"), self)
+        except BaseException:
+            self.handles.release()
+            raise
+
+    def run_lowered(self, func, *args):
+        # Без прав root пониженный приоритет потока обратно не поднять, поэтому работа идёт в отдельном
+        # потоке: приоритет понижается только ему и заканчивается вместе с ним
+        if not self.low_priority or platform.system() != "Linux":
+            return func(*args)
+        result = {}
+
+        def run():
+            self.lower_thread_priority()
+            try:
+                result["value"] = func(*args)
+            except BaseException as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run, name=threading.current_thread().name + "-low")
+        thread.start()
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+    def lower_thread_priority(self):
+        # nice и ionice для текущего потока: в Linux приоритет задаётся по идентификатору потока
+        if not self.low_priority or platform.system() != "Linux":
+            return
+        tid = threading.get_native_id()
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, 19)
+        except OSError as e:
+            logging.warning(f"Не удалось понизить приоритет CPU: {e}")
+        syscall_nr = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if syscall_nr is None:
+            return
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Не удалось понизить приоритет ввода-вывода: {e}")
+
+
+def _make_cdc_tables():
+    # Детерминированные таблица "байт -> бит" для bytes.translate и якорь из CDC_ANCHOR_BITS таких бит
+    bits = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+    seed = hashlib.sha256(b"cdc-anchor").digest()
+    anchor = bytes((seed[i // 8] >> (i % 8)) & 1 for i in range(CDC_ANCHOR_BITS))
+    return bits, anchor
+
+
+_CDC_BITS, _CDC_ANCHOR = _make_cdc_tables()
+
+
+def _find_chunk_boundary(buf):
+    # Байты не перебираются в цикле Python: кандидатов ищет bytes.find по переведённому
+    # в биты буферу, а CRC32 окна считается только для них (примерно раз на килобайт)
+    n = min(len(buf), CDC_MAX_SIZE)
+    if n <= CDC_MIN_SIZE:
+        return n
+    start = CDC_MIN_SIZE - CDC_ANCHOR_BITS + 1
+    bits = buf[start:n].translate(_CDC_BITS)
+    check_mask = (1 << CDC_CHECK_BITS) - 1
+    pos = bits.find(_CDC_ANCHOR)
+    while pos >= 0:
+        end = start + pos + CDC_ANCHOR_BITS
+        if not zlib.crc32(buf[end - CDC_WINDOW:end]) & check_mask:
+            return end
+        pos = bits.find(_CDC_ANCHOR, pos + 1)
+    return n
+
+
+def _iter_chunks(f):
+    # Границы блоков зависят только от содержимого, поэтому вставка данных
+    # в начало файла не сдвигает все последующие блоки
+    buf = b""
+    eof = False
+    while True:
+        if not eof and len(buf) < CDC_MAX_SIZE:
+            data = f.read(CDC_MAX_SIZE)
+            if data:
+                buf += data
+            else:
+                eof = True
+        if not buf:
+            return
+        if not eof and len(buf) < CDC_MAX_SIZE:
+            continue
+        cut = _find_chunk_boundary(buf)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+class ChunkStore:
+    """Хранилище блоков, адресуемых по SHA-256, и индексов снимков."""
+
+    def __init__(self, root, compression_level=6, create=True):
+        self.root = root
+        self.chunks_dir = os.path.join(root, "chunks")
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        self.compression_level = compression_level
+        self.chunks_new = 0
+        self.bytes_new = 0
+        self.bytes_reused = 0
+        if create:
+            os.makedirs(self.chunks_dir, exist_ok=True)
+            os.makedirs(self.snapshots_dir, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if os.path.exists(path):
+            self.bytes_reused += len(data)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = zlib.compress(data, self.compression_level) if self.compression_level > 0 else data
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"Z" if self.compression_level > 0 else b"S")
+            f.write(payload)
+        os.replace(tmp_path, path)
+        self.chunks_new += 1
+        self.bytes_new += len(data)
+        return digest
+
+    def get(self, digest):
+        with open(self._chunk_path(digest), "rb") as f:
+            kind = f.read(1)
+            data = f.read()
+        if kind == b"Z":
+            data = zlib.decompress(data)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Повреждён блок {digest}")
+        return data
+
+    def store_file(self, path, throttle=None):
+        with (throttle.open(path) if throttle else open(path, "rb")) as f:
+            return [self.put(chunk) for chunk in _iter_chunks(f)]
+
+    def restore_file(self, chunks, dest_path):
+        os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+        with open(dest_path, "wb") as f:
+            for digest in chunks:
+                f.write(self.get(digest))
+
+    def list_snapshots(self):
+        return sorted(name for name in os.listdir(self.snapshots_dir) if name.endswith(".json"))
+
+    def load_snapshot(self, name):
+        with open(os.path.join(self.snapshots_dir, name), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_snapshot(self, snapshot):
+        name = time.strftime("%Y%m%d-%H%M%S") + ".json"
+        _write_json_atomic(os.path.join(self.snapshots_dir, name), snapshot)
+        return name
+
+    def delete_snapshot(self, name):
+        os.remove(os.path.join(self.snapshots_dir, name))
+
+    def collect_garbage(self):
+        # Удаляем блоки, на которые не ссылается ни один оставшийся снимок
+        referenced = set()
+        for name in self.list_snapshots():
+            for entry in self.load_snapshot(name)["files"].values():
+                referenced.update(entry["chunks"])
+        removed = freed = 0
+        for prefix in os.listdir(self.chunks_dir):
+            folder = os.path.join(self.chunks_dir, prefix)
+            for digest in os.listdir(folder):
+                if digest not in referenced:
+                    path = os.path.join(folder, digest)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    removed += 1
+        return removed, freed
+
+    def restore_snapshot(self, name, dest_dir):
+        snapshot = self.load_snapshot(name)
+        for arcname, entry in snapshot["files"].items():
+            self.restore_file(entry["chunks"], os.path.join(dest_dir, *arcname.split("/")))
+        return len(snapshot["files"])
+
+    def export_zip(self, name, zip_path, compression_level=6):
+        # Снимок можно выгрузить в обычный zip-архив прежнего формата
+        snapshot = self.load_snapshot(name)
+        compression = ZIP_DEFLATED if compression_level > 0 else ZIP_STORED
+        with ZipFile(zip_path, 'w', compression,
+                     compresslevel=compression_level if compression == ZIP_DEFLATED else None) as zipf:
+            for arcname, entry in snapshot["files"].items():
+                with zipf.open(arcname, 'w', force_zip64=entry["size"] > 2 ** 31) as f:
+                    for digest in entry["chunks"]:
+                        f.write(self.get(digest))
+        return len(snapshot["files"])
+
+
+class LinkSnapshotStore:
+    """Полные снимки-деревья, в которых неизменённые файлы - жёсткие ссылки на прошлый снимок.
+
+    Как rsync --link-dest: каждый снимок можно просматривать как обычный каталог,
+    а запуск тратит время и место только на изменённые файлы. С reflink вместо
+    ссылок делаются клоны FICLONE - независимые файлы с общими блоками.
+    """
+
+    def __init__(self, root, reflink=False):
+        self.root = root
+        self.reflink = reflink and fcntl is not None
+        self.linked = 0
+        self.cloned = 0
+        self.copied = 0
+        self.bytes_copied = 0
+        self.bytes_reused = 0
+        self._made_dirs = set()
+        os.makedirs(root, exist_ok=True)
+
+    def list_snapshots(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if re.fullmatch(r"\d{8}-\d{6}", name) and os.path.isdir(os.path.join(self.root, name)))
+
+    def begin(self):
+        # Возвращает (каталог, продолжается ли прерванный снимок). Уже записанные
+        # в недописанный снимок файлы при совпадении с источником не трогаются
+        partials = sorted(name for name in os.listdir(self.root)
+                          if re.fullmatch(r"\d{8}-\d{6}" + re.escape(PARTIAL_SUFFIX), name))
+        for name in partials[:-1]:
+            shutil.rmtree(os.path.join(self.root, name))
+        if partials:
+            return os.path.join(self.root, partials[-1]), True
+        while True:
+            name = time.strftime("%Y%m%d-%H%M%S")
+            if not os.path.exists(os.path.join(self.root, name)):
+                break
+            time.sleep(0.2)
+        path = os.path.join(self.root, name + PARTIAL_SUFFIX)
+        os.makedirs(path)
+        return path, False
+
+    def add_file(self, filepath, arcname, st, partial_dir, previous_dir, throttle=None, retries=0):
+        # Возвращает False, если файл менялся во время копирования
+        dest = os.path.join(partial_dir, *arcname.split("/"))
+        folder = os.path.dirname(dest)
+        if folder not in self._made_dirs:
+            os.makedirs(folder, exist_ok=True)
+            self._made_dirs.add(folder)
+        if os.path.lexists(dest):
+            if _same_content(os.lstat(dest), st):
+                self.bytes_reused += st.st_size
+                return True
+            os.remove(dest)
+        if previous_dir and self.reuse_previous(arcname, dest, previous_dir, st):
+            return True
+        return self._copy(filepath, dest, throttle, retries)
+
+    def reuse_previous(self, arcname, dest, previous_dir, st=None):
+        # Ссылка (или клон) на версию из прошлого снимка; st=None - взять её как есть
+        previous = os.path.join(previous_dir, *arcname.split("/"))
+        try:
+            previous_st = os.lstat(previous)
+        except FileNotFoundError:
+            return False
+        if st is not None and not _same_content(previous_st, st):
+            return False
+        if self.reflink and self._clone(previous, dest, previous_st):
+            self.cloned += 1
+        else:
+            try:
+                os.link(previous, dest)
+            except OSError as e:
+                # Исчерпан предел ссылок на inode или ФС их не поддерживает: файл будет скопирован
+                if e.errno not in (errno.EMLINK, errno.EPERM, errno.EXDEV, errno.ENOTSUP):
+                    raise
+                return False
+            self.linked += 1
+        self.bytes_reused += previous_st.st_size
+        return True
+
+    def _clone(self, source, dest, source_st):
+        try:
+            with open(source, "rb") as src, open(dest, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            # ФС без клонирования - дальше только жёсткие ссылки
+            self.reflink = False
+            return False
+        shutil.copymode(source, dest)
+        os.utime(dest, ns=(source_st.st_atime_ns, source_st.st_mtime_ns))
+        return True
+
+    def _copy(self, filepath, dest, throttle, retries):
+        tmp_path = dest + ".tmp"
+        delay = CONSISTENCY_RETRY_DELAY
+        attempt = 0
+        while True:
+            before = os.stat(filepath)
+            with (throttle.open(filepath) if throttle else open(filepath, "rb")) as f, open(tmp_path, "wb") as out:
+                shutil.copyfileobj(f, out, COPY_BLOCK_SIZE)
+                size = out.tell()
+            after = os.stat(filepath)
+            consistent = _same_version(before, after) and size == after.st_size
+            if consistent or attempt >= retries:
+                break
+            attempt += 1
+            time.sleep(delay)
+            delay *= 2
+        shutil.copymode(filepath, tmp_path)
+        # Несогласованная копия получает прежнее время изменения: следующий запуск её заменит
+        mtime_ns = after.st_mtime_ns if consistent else before.st_mtime_ns - 1
+        os.utime(tmp_path, ns=(after.st_atime_ns, mtime_ns))
+        os.replace(tmp_path, dest)
+        self.copied += 1
+        self.bytes_copied += size
+        return consistent
+
+    def prune(self, partial_dir, arcnames):
+        # Удаляет из продолжаемого снимка файлы, которых больше нет в источниках
+        removed = 0
+        for folder, _dirs, names in os.walk(partial_dir, topdown=False):
+            rel = os.path.relpath(folder, partial_dir).replace(os.sep, "/")
+            for name in names:
+                arcname = name if rel == "." else rel + "/" + name
+                if arcname not in arcnames:
+                    os.remove(os.path.join(folder, name))
+                    removed += 1
+            if folder != partial_dir and not os.listdir(folder):
+                os.rmdir(folder)
+        return removed
+
+    def commit(self, partial_dir):
+        name = os.path.basename(partial_dir)[:-len(PARTIAL_SUFFIX)]
+        os.rename(partial_dir, os.path.join(self.root, name))
+        return name
+
+    def delete_snapshot(self, name):
+        shutil.rmtree(os.path.join(self.root, name))
+
+
+def _glob_to_regex(pattern):
+    # Перевод маски в стиле .gitignore в регулярное выражение: * и ? не пересекают "/", ** - пересекает
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**", i):
+                if pattern.startswith("**/", i):
+                    out.append("(?:.*/)?")
+                    i += 3
+                else:
+                    out.append(".*")
+                    i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2 if pattern.startswith("[!", i) else i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class ExcludeRules:
+    """Правила исключения в стиле .gitignore, скомпилированные в несколько регулярных выражений.
+
+    Пути проверяются относительно корня источника через "/". Поддерживаются
+    якорные пути, **, отрицание через ! и правила только для каталогов
+    (с "/" на конце). Подряд идущие правила одного знака объединяются в одно
+    выражение; группы проверяются с конца, поэтому выигрывает последнее
+    совпавшее правило, как в git.
+    """
+
+    def __init__(self, patterns):
+        flags = re.IGNORECASE if os.name == "nt" else 0
+        groups = []
+        for line in patterns:
+            rule = self._parse(line)
+            if rule is None:
+                continue
+            negate, dir_only, regex = rule
+            if not groups or groups[-1][0] != negate:
+                groups.append((negate, [], []))
+            (groups[-1][2] if dir_only else groups[-1][1]).append(regex)
+        self._groups = []
+        for negate, any_rules, dir_rules in groups:
+            any_re = re.compile("|".join(any_rules), flags) if any_rules else None
+            dir_re = re.compile("|".join(any_rules + dir_rules), flags)
+            self._groups.append((negate, any_re, dir_re))
+        self._groups.reverse()
+
+    @staticmethod
+    def _parse(line):
+        line = line.rstrip("\n\r")
+        if not line.strip() or line.startswith("#"):
+            return None
+        line = line.strip()
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+        # Маска со "/" в начале или в середине привязана к корню источника
+        anchored = "/" in line
+        body = _glob_to_regex(line.lstrip("/"))
+        regex = "(?:" + ("" if anchored else "(?:.*/)?") + body + ")$"
+        return negate, dir_only, regex
+
+    @classmethod
+    def for_source(cls, patterns, source_dir):
+        rules = list(patterns)
+        ignore_path = os.path.join(source_dir, IGNORE_FILE_NAME)
+        if os.path.isfile(ignore_path):
+            with open(ignore_path, "r", encoding="utf-8") as f:
+                rules.extend(f.read().splitlines())
+        return cls(rules)
+
+    def __bool__(self):
+        return bool(self._groups)
+
+    def is_excluded(self, rel_path, is_dir=False):
+        for negate, any_re, dir_re in self._groups:
+            regex = dir_re if is_dir else any_re
+            if regex is not None and regex.match(rel_path):
+                return not negate
+        return False
+
+
+class InotifyWatcher:
+    """Наблюдение за деревьями каталогов через inotify (только Linux).
+
+    Изменённые пути копятся в множестве до вызова take_changes. Новые каталоги
+    ставятся на наблюдение по мере появления. При переполнении очереди событий
+    ядра часть изменений потеряна, и вызывающий должен пересканировать источники.
+    """
+
+    def __init__(self, accept=None):
+        # accept(path) решает, наблюдать ли за каталогом (исключённые не наблюдаются)
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self._accept = accept
+        self._paths = {}
+        self._wds = {}
+        self._dirty = set()
+        self._overflow = False
+
+    @property
+    def watch_count(self):
+        return len(self._wds)
+
+    def add_tree(self, root):
+        stack = [root]
+        while stack:
+            folder = stack.pop()
+            if folder in self._wds or (self._accept and not self._accept(folder)):
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                # Каталог успел исчезнуть - его удаление придёт событием от родителя
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(err, f"inotify_add_watch {folder}: {os.strerror(err)}")
+            self._paths[wd] = folder
+            self._wds[folder] = wd
+            try:
+                with os.scandir(folder) as it:
+                    stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def _forget_tree(self, root):
+        prefix = root + os.sep
+        for folder in [f for f in self._wds if f == root or f.startswith(prefix)]:
+            wd = self._wds.pop(folder)
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def poll(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(data):
+                wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, pos)
+                pos += INOTIFY_EVENT.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b"\0"))
+                pos += length
+                self._handle(wd, mask, name)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._overflow = True
+            return
+        folder = self._paths.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self._paths[wd]
+            if self._wds.get(folder) == wd:
+                del self._wds[folder]
+            return
+        path = os.path.join(folder, name) if name else folder
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                self._forget_tree(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.add_tree(path)
+                except OSError:
+                    # Не хватило наблюдений (max_user_watches): изменения в новом каталоге не увидим
+                    self._overflow = True
+            elif not mask & IN_DELETE:
+                # Смена атрибутов каталога не меняет содержимое архива
+                return
+        self._dirty.add(path)
+
+    def take_changes(self):
+        # Возвращает (изменённые пути, было ли переполнение) и начинает накопление заново
+        changes, overflow = self._dirty, self._overflow
+        self._dirty, self._overflow = set(), False
+        return changes, overflow
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+class BackupProgress:
+    """Счётчики хода резервного копирования.
+
+    Рабочие потоки меняют счётчики только методами под блокировкой, а интерфейс
+    и другие потребители сами опрашивают snapshot() с нужной частотой. Пока обход
+    источников не завершён, общий объём оценивается как максимум из
+    найденного на данный момент и итогов прошлого запуска.
+    """
+
+    def __init__(self, expected_files=0, expected_bytes=0):
+        self.expected_files = expected_files
+        self.expected_bytes = expected_bytes
+        self.files_found = 0
+        self.bytes_found = 0
+        self.scan_done = False
+        # Время обхода источников без ожидания места в очереди, с
+        self.scan_time = 0.0
+        self.files_done = 0
+        self.bytes_done = 0
+        # Ошибки обхода и чтения файлов за запуск
+        self.errors = 0
+        self.started = time.monotonic()
+        self.finished = None
+        # Счётчики меняют поток обхода, основной поток и потоки записи
+        self._lock = threading.Lock()
+
+    def found(self, size):
+        with self._lock:
+            self.files_found += 1
+            self.bytes_found += size
+
+    def done(self, size):
+        with self._lock:
+            self.files_done += 1
+            self.bytes_done += size
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def scan_finished(self, scan_time):
+        with self._lock:
+            self.scan_time = scan_time
+            self.scan_done = True
+
+    def finish(self):
+        with self._lock:
+            self.finished = time.monotonic()
+
+    def _totals(self):
+        if self.scan_done:
+            return self.files_found, self.bytes_found
+        return max(self.files_found, self.expected_files), max(self.bytes_found, self.expected_bytes)
+
+    def fraction(self):
+        total_files, total_bytes = self._totals()
+        if total_bytes > 0:
+            return min(1.0, self.bytes_done / total_bytes)
+        if total_files > 0:
+            return min(1.0, self.files_done / total_files)
+        return 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        elapsed = max(1e-6, (self.finished or time.monotonic()) - self.started)
+        total_files, total_bytes = self._totals()
+        bytes_per_sec = self.bytes_done / elapsed
+        files_per_sec = self.files_done / elapsed
+        eta = None
+        if self.finished is None:
+            if bytes_per_sec > 0 and total_bytes > 0:
+                eta = max(0.0, (total_bytes - self.bytes_done) / bytes_per_sec)
+            elif files_per_sec > 0 and total_files > 0:
+                eta = max(0.0, (total_files - self.files_done) / files_per_sec)
+        return {
+            "fraction": round(self.fraction(), 4),
+            "files_done": self.files_done,
+            "bytes_done": self.bytes_done,
+            "files_found": self.files_found,
+            "bytes_found": self.bytes_found,
+            "scan_done": self.scan_done,
+            "errors": self.errors,
+            "elapsed": round(elapsed, 1),
+            "files_per_sec": round(files_per_sec, 1),
+            "mb_per_sec": round(bytes_per_sec / 1024 / 1024, 2),
+            "eta": round(eta, 1) if eta is not None else None,
+            "finished": self.finished is not None,
+        }
+
+
+def _byte_entropy(data):
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+class CodecPolicy:
+    """Выбор кодека для каждого файла по расширению или по энтропии первого блока.
+
+    Также собирает по каждому кодеку объём до и после сжатия и процессорное время,
+    а по каждому расширению - объём до и после сжатия для предварительной оценки.
+    """
+
+    def __init__(self, compression_level, codec_rules=None, default_codec="deflate"):
+        self.compression_level = compression_level
+        self.default_codec = default_codec if compression_level > 0 else "store"
+        self.rules = dict(DEFAULT_CODEC_RULES)
+        self.rules.update({ext.lower(): codec for ext, codec in (codec_rules or {}).items()})
+        self.stats = {}
+        self.extensions = {}
+        self._lock = threading.Lock()
+
+    def choose(self, arcname, first_block):
+        if self.compression_level <= 0:
+            return "store"
+        codec = self.rules.get(os.path.splitext(arcname)[1].lower())
+        if codec in CODEC_TYPES:
+            return codec
+        if _byte_entropy(first_block[:ENTROPY_PROBE_SIZE]) > ENTROPY_STORE_THRESHOLD:
+            return "store"
+        return self.default_codec
+
+    def record(self, codec, bytes_in, bytes_out, cpu_time, arcname=None):
+        with self._lock:
+            stat = self.stats.setdefault(codec, {"files": 0, "bytes_in": 0, "bytes_out": 0, "cpu_time": 0.0})
+            stat["files"] += 1
+            stat["bytes_in"] += bytes_in
+            stat["bytes_out"] += bytes_out
+            stat["cpu_time"] += cpu_time
+            if arcname is not None:
+                ext = self.extensions.setdefault(os.path.splitext(arcname)[1].lower(), [0, 0])
+                ext[0] += bytes_in
+                ext[1] += bytes_out
+
+
+def _make_compressor(compress_type, level):
+    if compress_type == ZIP_DEFLATED:
+        return zlib.compressobj(level, zlib.DEFLATED, -15)
+    if compress_type == ZIP_BZIP2:
+        return bz2.BZ2Compressor(level or 9)
+    if compress_type == ZIP_LZMA:
+        return zipfile.LZMACompressor()
+    return None
+
+
+def _block_digest(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+class _BlockHasher:
+    """Обёртка над файлом, которая по ходу чтения считает подписи блоков фиксированного размера."""
+
+    def __init__(self, f, block_size):
+        self._f = f
+        self.block_size = block_size
+        self.blocks = []
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._filled = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            take = min(self.block_size - self._filled, len(view) - pos)
+            self._hash.update(view[pos:pos + take])
+            self._filled += take
+            pos += take
+            if self._filled == self.block_size:
+                self._next_block()
+        return data
+
+    def _next_block(self):
+        self.blocks.append(self._hash.hexdigest())
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._filled = 0
+
+    def finish(self):
+        if self._filled:
+            self._next_block()
+        return self.blocks
+
+
+class _DigestReader:
+    """Обёртка над файлом, которая по ходу чтения считает SHA-256 всего содержимого, как _file_digest."""
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class _DeltaJob:
+    """Подписи прошлой версии большого файла и итог записи новой версии.
+
+    Без подписей (blocks=None) файл пишется целиком, а подписи считаются
+    попутно. Иначе в архив идут только блоки, подпись которых изменилась.
+    После записи new_blocks и size описывают записанную версию, а changed -
+    число изменённых блоков (None для целой копии).
+    """
+
+    def __init__(self, block_size, blocks=None, chain=0):
+        self.block_size = block_size
+        self.blocks = blocks
+        self.chain = chain
+        self.new_blocks = None
+        self.size = None
+        self.changed = None
+
+    def write_diff(self, f, out):
+        # Сравнение идёт по блокам на тех же смещениях: правка на месте (образы ВМ, базы
+        # данных, дописывание в конец) даёт дельту по числу изменённых байтов
+        out.write(DELTA_MAGIC)
+        out.write(DELTA_HEADER.pack(0, 0, 0))
+        new_blocks = []
+        changed = 0
+        size = 0
+        while True:
+            block = f.read(self.block_size)
+            if not block:
+                break
+            digest = _block_digest(block)
+            index = len(new_blocks)
+            new_blocks.append(digest)
+            if index >= len(self.blocks) or self.blocks[index] != digest:
+                out.write(DELTA_BLOCK_INDEX.pack(index))
+                out.write(block)
+                changed += 1
+            size += len(block)
+        out.seek(len(DELTA_MAGIC))
+        out.write(DELTA_HEADER.pack(size, self.block_size, changed))
+        out.seek(0, os.SEEK_END)
+        self.new_blocks = new_blocks
+        self.size = size
+        self.changed = changed
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("дельта обрывается раньше заявленного размера")
+    return data
+
+
+def _apply_delta(delta, dest_path):
+    # Изменённые блоки пишутся поверх прошлой версии, уже восстановленной из более раннего архива
+    if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError(f"неизвестный формат дельты для {dest_path}")
+    size, block_size, count = DELTA_HEADER.unpack(_read_exact(delta, DELTA_HEADER.size))
+    with open(dest_path, "r+b") as f:
+        f.truncate(size)
+        for _ in range(count):
+            index, = DELTA_BLOCK_INDEX.unpack(_read_exact(delta, DELTA_BLOCK_INDEX.size))
+            f.seek(index * block_size)
+            f.write(_read_exact(delta, min(block_size, size - index * block_size)))
+
+
+class _DuplicateFinder:
+    """Поиск файлов с уже записанным в этом запуске содержимым.
+
+    Хеш файла считается в потоке сжатия по тем же блокам, что уходят в архив,
+    поэтому повтор не перечитывается отдельно, а совпадение проверяется при
+    записи, в порядке постановки файлов. Если хеш известен заранее (hash_files),
+    повтор вообще не сжимается и ждёт записи оригинала.
+    """
+
+    def __init__(self, min_size):
+        self.min_size = min_size
+        # хеш -> путь в архиве первого поставленного файла с этим содержимым
+        self._expected = {}
+        # хеш -> путь в архиве записи, сохранённой целиком и согласованно: только на неё можно ссылаться
+        self._stored = {}
+
+    def wants(self, st):
+        return st.st_size >= self.min_size
+
+    def expect(self, arcname, digest):
+        # True - файл с тем же хешем уже поставлен раньше, и этот можно не сжимать
+        if digest in self._stored or digest in self._expected:
+            return True
+        self._expected[digest] = arcname
+        return False
+
+    def stored(self, digest):
+        return self._stored.get(digest)
+
+    def record(self, arcname, digest):
+        self._stored.setdefault(digest, arcname)
+
+
+def _same_content(snapshot_st, source_st):
+    # Файл снимка хранит размер и время изменения источника на момент копирования
+    return (snapshot_st.st_size, snapshot_st.st_mtime_ns) == (source_st.st_size, source_st.st_mtime_ns)
+
+
+def _same_version(before, after):
+    # Размер, время изменения содержимого и метаданных совпали - файл за это время не трогали
+    return ((before.st_size, before.st_mtime_ns, before.st_ctime_ns)
+            == (after.st_size, after.st_mtime_ns, after.st_ctime_ns))
+
+
+class ParallelZipWriter:
+    """Сжимает файлы в пуле потоков и дописывает готовые записи в архив строго по порядку.
+
+    zlib, bz2 и lzma отпускают GIL во время сжатия, поэтому потоки занимают
+    все ядра, а запись в ZipFile остаётся однопоточной. Кодек каждой записи
+    выбирает CodecPolicy, а готовые записи уходят в ZipFanout - во все цели
+    сразу. Файл, изменившийся во время чтения, перечитывается
+    до retries раз; файлы под правилами staging сначала копируются во
+    временный файл, чтобы окно несогласованности было как можно короче.
+    Большие файлы с подписями прошлой версии пишутся дельтой (_DeltaJob),
+    а повторы уже записанного содержимого (_DuplicateFinder) - ссылкой в refs.
+    """
+
+    def __init__(self, archives, workers, policy, throttle, retries=0, staging=None, duplicates=None):
+        self.archives = archives
+        self.duplicates = duplicates
+        self.policy = policy
+        self.throttle = throttle
+        self.retries = retries
+        self.staging = staging
+        self.written = 0
+        # Итоги проверки согласованности
+        self.retried = 0
+        self.staged = 0
+        self.inconsistent = []
+        # Файлы, записанные дельтой, и сколько блоков в них изменилось из общего числа
+        self.deltas = []
+        self.delta_blocks_changed = 0
+        self.delta_blocks_total = 0
+        # Повторы: {путь повтора: путь записанной копии} и сколько байт не пришлось записывать
+        self.refs = {}
+        self.bytes_deduplicated = 0
+        # Суммарное время потоков на чтение и сжатие, с
+        self.read_time = 0.0
+        self.compress_time = 0.0
+        # Сколько основной поток ждал готовых записей от потоков сжатия, с
+        self.wait_time = 0.0
+        self._times_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                            initializer=throttle.lower_thread_priority)
+        self._pending = deque()
+        self._max_pending = max(1, workers) * 2
+
+    def submit(self, filepath, arcname, on_done, delta=None, st=None, digest=None):
+        # on_done(error, consistent) вызывается в потоке записи после записи или ошибки;
+        # delta - _DeltaJob для больших файлов; st и digest (если уже посчитан) нужны для поиска повторов
+        hashed = (self.duplicates is not None and delta is None and st is not None
+                  and self.duplicates.wants(st))
+        if hashed and digest is not None and self.duplicates.expect(arcname, digest):
+            # Решение откладывается до записи оригинала: если он не записался, повтор сжимается сам
+            self._pending.append((None, on_done, None, (filepath, arcname, digest, st.st_size)))
+        else:
+            self._pending.append((self._submit_compress(filepath, arcname, delta, hashed), on_done, delta, None))
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def close(self):
+        try:
+            while self._pending:
+                self._write_next()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def _submit_compress(self, filepath, arcname, delta=None, hashed=False):
+        # Результат - (zinfo, payload, число повторов, согласована ли копия, была ли промежуточная копия,
+        # хеш содержимого или None, если hashed не задан).
+        # Пауза перед повтором ждёт в таймере, а не в потоке пула: файл, в который пишут,
+        # не занимает поток сжатия, пока остальные файлы ждут своей очереди
+        result = Future()
+        self._submit_attempt(result, filepath, arcname, delta, hashed, 0, CONSISTENCY_RETRY_DELAY)
+        return result
+
+    def _submit_attempt(self, result, filepath, arcname, delta, hashed, attempt, delay):
+        try:
+            future = self._executor.submit(self._compress_file, filepath, arcname, delta, hashed)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        future.add_done_callback(
+            lambda f: self._attempt_done(f, result, filepath, arcname, delta, hashed, attempt, delay))
+
+    def _attempt_done(self, future, result, filepath, arcname, delta, hashed, attempt, delay):
+        try:
+            zinfo, payload, codec, cpu_time, consistent, staged, digest = future.result()
+        except Exception as e:
+            result.set_exception(e)
+            return
+        if consistent or attempt >= self.retries:
+            # Дельта сжимается иначе, чем файл целиком, и в оценку по расширениям не идёт
+            self.policy.record(codec, zinfo.file_size, zinfo.compress_size, cpu_time,
+                               arcname if delta is None else None)
+            result.set_result((zinfo, payload, attempt, consistent, staged, digest))
+            return
+        payload.close()
+        timer = threading.Timer(delay, self._submit_attempt,
+                                (result, filepath, arcname, delta, hashed, attempt + 1, delay * 2))
+        timer.daemon = True
+        timer.start()
+
+    def _compress_file(self, filepath, arcname, delta=None, hashed=False):
+        # Одна попытка: (zinfo, payload, кодек, время CPU, согласована ли копия, была ли промежуточная копия,
+        # хеш прочитанного содержимого, если задан hashed)
+        staged = bool(self.staging and self.staging.is_excluded(arcname))
+        before = os.stat(filepath)
+        if staged:
+            with tempfile.TemporaryFile() as copy:
+                copy_started = time.monotonic()
+                with self.throttle.open(filepath) as f:
+                    shutil.copyfileobj(f, copy, COPY_BLOCK_SIZE)
+                after = os.stat(filepath)
+                with self._times_lock:
+                    self.read_time += time.monotonic() - copy_started
+                copy.seek(0)
+                reader = _DigestReader(copy) if hashed else copy
+                zinfo, payload, codec, cpu_time, size = self._compress_source(filepath, arcname, reader, delta)
+        else:
+            with self.throttle.open(filepath) as f:
+                reader = _DigestReader(f) if hashed else f
+                zinfo, payload, codec, cpu_time, size = self._compress_source(filepath, arcname, reader, delta)
+            after = os.stat(filepath)
+        consistent = _same_version(before, after) and size == after.st_size
+        digest = reader.hexdigest() if hashed else None
+        return zinfo, payload, codec, cpu_time, consistent, staged, digest
+
+    def _compress_source(self, filepath, arcname, f, delta):
+        # То же, что _compress_stream, плюс размер прочитанного файла: у дельты он не совпадает с размером записи
+        if delta is None:
+            result = self._compress_stream(filepath, arcname, f)
+            return result + (result[0].file_size,)
+        if delta.blocks is None:
+            hasher = _BlockHasher(f, delta.block_size)
+            result = self._compress_stream(filepath, arcname, hasher)
+            delta.new_blocks = hasher.finish()
+            delta.size = result[0].file_size
+            delta.changed = None
+            return result + (delta.size,)
+        with tempfile.TemporaryFile() as diff:
+            delta.write_diff(f, diff)
+            diff.seek(0)
+            return self._compress_stream(filepath, arcname + DELTA_SUFFIX, diff) + (delta.size,)
+
+    def _compress_stream(self, filepath, arcname, f):
+        zinfo = ZipInfo.from_file(filepath, arcname)
+        payload = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        try:
+            cpu_start = time.thread_time()
+            crc = 0
+            file_size = 0
+            read_time = 0.0
+            mark = time.monotonic()
+            block = f.read(COPY_BLOCK_SIZE)
+            read_time += time.monotonic() - mark
+            codec = self.policy.choose(arcname, block)
+            zinfo.compress_type = CODEC_TYPES[codec]
+            if zinfo.compress_type == ZIP_LZMA:
+                zinfo.flag_bits |= 0x02  # в потоке LZMA есть маркер конца данных
+            compressor = _make_compressor(zinfo.compress_type, self.policy.compression_level)
+            while block:
+                file_size += len(block)
+                crc = zlib.crc32(block, crc)
+                payload.write(compressor.compress(block) if compressor else block)
+                mark = time.monotonic()
+                block = f.read(COPY_BLOCK_SIZE)
+                read_time += time.monotonic() - mark
+            if compressor:
+                payload.write(compressor.flush())
+            with self._times_lock:
+                self.read_time += read_time
+                self.compress_time += time.thread_time() - cpu_start
+            zinfo.file_size = file_size
+            zinfo.CRC = crc
+            zinfo.compress_size = payload.tell()
+            payload.seek(0)
+            return zinfo, payload, codec, time.thread_time() - cpu_start
+        except BaseException:
+            payload.close()
+            raise
+
+    def _write_next(self):
+        future, on_done, delta, duplicate = self._pending.popleft()
+        if duplicate is not None:
+            filepath, arcname, digest, size = duplicate
+            original = self.duplicates.stored(digest)
+            if original is not None:
+                self._add_ref(arcname, original, size, on_done)
+                return
+            future = self._submit_compress(filepath, arcname, hashed=True)
+        started = time.monotonic()
+        try:
+            zinfo, payload, retries, consistent, staged, digest = future.result()
+        except Exception as e:
+            on_done(e, True)
+            return
+        finally:
+            self.wait_time += time.monotonic() - started
+        if digest is not None and consistent:
+            original = self.duplicates.stored(digest)
+            if original is not None:
+                # Повтор уже сжат, но в архив не пишется: его содержимое прочитано один раз
+                payload.close()
+                self._add_ref(zinfo.filename, original, zinfo.file_size, on_done)
+                return
+        try:
+            self.archives.append(zinfo, payload)
+        except Exception as e:
+            payload.close()
+            on_done(e, True)
+            return
+        self.written += 1
+        if digest is not None and consistent:
+            self.duplicates.record(zinfo.filename, digest)
+        if delta is not None and delta.changed is not None:
+            self.deltas.append(zinfo.filename[:-len(DELTA_SUFFIX)])
+            self.delta_blocks_changed += delta.changed
+            self.delta_blocks_total += len(delta.new_blocks)
+        self.retried += retries > 0
+        self.staged += staged
+        if not consistent:
+            self.inconsistent.append(zinfo.filename)
+        on_done(None, consistent)
+
+    def _add_ref(self, arcname, original, size, on_done):
+        self.refs[arcname] = original
+        self.bytes_deduplicated += size
+        on_done(None, True)
+
+    def consistency_stats(self):
+        return {"retried": self.retried, "staged": self.staged, "inconsistent": list(self.inconsistent)}
+
+
+class _SharedPayload:
+    """Сжатые данные одной записи, которые читают все цели; закрываются после последней."""
+
+    def __init__(self, payload, readers, on_closed=None):
+        self._payload = payload
+        self._readers = readers
+        self._on_closed = on_closed
+        self._lock = threading.Lock()
+
+    def copy_to(self, fp):
+        offset = 0
+        while True:
+            with self._lock:
+                self._payload.seek(offset)
+                block = self._payload.read(COPY_BLOCK_SIZE)
+            if not block:
+                return
+            fp.write(block)
+            offset += len(block)
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            if self._readers == 0:
+                self._payload.close()
+                if self._on_closed:
+                    self._on_closed()
+
+
+def _zinfo_to_dict(zinfo):
+    return {"name": zinfo.filename, "date_time": list(zinfo.date_time), "compress_type": zinfo.compress_type,
+            "flag_bits": zinfo.flag_bits, "crc": zinfo.CRC, "compress_size": zinfo.compress_size,
+            "file_size": zinfo.file_size, "header_offset": zinfo.header_offset,
+            "external_attr": zinfo.external_attr, "create_system": zinfo.create_system,
+            "create_version": zinfo.create_version, "extract_version": zinfo.extract_version}
+
+
+def _zinfo_from_dict(data):
+    zinfo = ZipInfo(data["name"], tuple(data["date_time"]))
+    zinfo.compress_type = data["compress_type"]
+    zinfo.flag_bits = data["flag_bits"]
+    zinfo.CRC = data["crc"]
+    zinfo.compress_size = data["compress_size"]
+    zinfo.file_size = data["file_size"]
+    zinfo.header_offset = data["header_offset"]
+    zinfo.external_attr = data["external_attr"]
+    zinfo.create_system = data["create_system"]
+    zinfo.create_version = data["create_version"]
+    zinfo.extract_version = data["extract_version"]
+    return zinfo
+
+
+class _CheckpointMarker:
+    """Метка в очереди цели: всё, что стоит перед ней, уже записано на диск."""
+
+    def __init__(self):
+        self.state = None
+        self.done = threading.Event()
+
+
+class _ArchiveSink:
+    """Архив одной цели, записи в который дописываются в отдельном потоке.
+
+    Пока запуск не завершён, архив лежит под суффиксом PARTIAL_SUFFIX. Если
+    передано состояние контрольной точки, недописанный архив обрезается до
+    зафиксированного смещения и запись продолжается с него.
+    """
+
+    def __init__(self, archive_path, compression, compresslevel, queue_size, resume_state=None):
+        self.archive_path = archive_path
+        self.partial_path = archive_path + PARTIAL_SUFFIX
+        self.error = None
+        self.entries = []
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        # Сколько запись ждала места в очереди цели: цель не успевает за сжатием, с
+        self.wait_time = 0.0
+        self.zipf = None
+        self._fp = None
+        try:
+            os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+            if resume_state is None:
+                self.zipf = ZipFile(self.partial_path, 'w', compression, compresslevel=compresslevel)
+            elif not resume_state:
+                raise ValueError("для цели нет контрольной точки прерванного запуска")
+            else:
+                self._fp = open(self.partial_path, "r+b")
+                self._fp.truncate(resume_state["offset"])
+                self._fp.seek(resume_state["offset"])
+                # ZipFile в режиме 'w' на открытом файле начинает запись с текущей позиции
+                self.zipf = ZipFile(self._fp, 'w', compression, compresslevel=compresslevel)
+                for data in resume_state["entries"]:
+                    zinfo = _zinfo_from_dict(data)
+                    self.zipf.filelist.append(zinfo)
+                    self.zipf.NameToInfo[zinfo.filename] = zinfo
+        except Exception as e:
+            self.error = e
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, item, data):
+        started = time.monotonic()
+        self._queue.put((item, data))
+        self.wait_time += time.monotonic() - started
+
+    def close(self, finalize=True):
+        # finalize=False оставляет недописанный архив для продолжения по контрольной точке
+        self._queue.put(None)
+        self._thread.join()
+        if self.zipf is None:
+            return
+        try:
+            if not finalize:
+                self.zipf._didModify = False  # не дописывать центральный каталог
+            self.zipf.close()
+            if self._fp:
+                self._fp.close()
+            if finalize and self.error is None:
+                self.entries = self.zipf.infolist()
+                os.replace(self.partial_path, self.archive_path)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            item, data = task
+            if isinstance(item, _CheckpointMarker):
+                if self.error is None:
+                    try:
+                        self.zipf.fp.flush()
+                        os.fsync(self.zipf.fp.fileno())
+                        item.state = {"offset": self.zipf.start_dir,
+                                      "entries": [_zinfo_to_dict(z) for z in self.zipf.filelist]}
+                    except Exception as e:
+                        self.error = e
+                item.done.set()
+                continue
+            if self.error is None:
+                started = time.monotonic()
+                try:
+                    if isinstance(item, ZipInfo):
+                        self._append_entry(item, data)
+                    else:
+                        self.zipf.writestr(item, data)
+                except Exception as e:
+                    self.error = e
+                self.busy_time += time.monotonic() - started
+            if isinstance(data, _SharedPayload):
+                data.release()
+
+    def _append_entry(self, zinfo, payload):
+        # То же, что делает ZipFile.open(..., 'w'), но для уже сжатых данных
+        zipf = self.zipf
+        zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        payload.copy_to(zipf.fp)
+        zipf.start_dir = zipf.fp.tell()
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        self.bytes_written += zipf.start_dir - zinfo.header_offset
+
+
+class ZipFanout:
+    """Один поток готовых записей, записываемый в одноимённые архивы нескольких целей.
+
+    Каждый архив пишется в своём потоке через ограниченную очередь, поэтому
+    файл читается и сжимается один раз, а медленная цель тормозит остальные
+    не раньше, чем заполнится её очередь. Объём записей в памяти, ещё не
+    дописанных всеми целями, ограничен FANOUT_MAX_MEMORY. Ошибка записи
+    выключает только свою цель, остальные архивы дописываются до конца.
+    """
+
+    def __init__(self, archive_paths, compression, compresslevel, queue_size, resume_states=None):
+        resume_states = resume_states or [None] * len(archive_paths)
+        self.sinks = [_ArchiveSink(path, compression, compresslevel, queue_size, state)
+                      for path, state in zip(archive_paths, resume_states)]
+        # Сколько ждали освобождения памяти, занятой недописанными записями, с
+        self.wait_time = 0.0
+        self._memory = 0
+        self._memory_freed = threading.Condition()
+
+    def _live_sinks(self):
+        live = [sink for sink in self.sinks if sink.error is None]
+        if not live:
+            raise OSError("запись не удалась ни в одну из целей: " + "; ".join(str(s.error) for s in self.sinks))
+        return live
+
+    def append(self, zinfo, payload):
+        live = self._live_sinks()
+        # Записи больше SPOOL_MAX_MEMORY лежат во временных файлах и память не занимают
+        size = zinfo.compress_size if zinfo.compress_size <= SPOOL_MAX_MEMORY else 0
+        if size:
+            started = time.monotonic()
+            with self._memory_freed:
+                while self._memory and self._memory + size > FANOUT_MAX_MEMORY:
+                    self._memory_freed.wait()
+                self._memory += size
+            self.wait_time += time.monotonic() - started
+        shared = _SharedPayload(payload, len(live), (lambda: self._release_memory(size)) if size else None)
+        for sink in live:
+            # У каждого архива своё смещение записи, поэтому ZipInfo копируется
+            sink.put(copy.copy(zinfo), shared)
+
+    def _release_memory(self, size):
+        with self._memory_freed:
+            self._memory -= size
+            self._memory_freed.notify_all()
+
+    def writestr(self, name, data):
+        for sink in self._live_sinks():
+            sink.put(name, data)
+
+    def checkpoint(self):
+        # Ждёт, пока все цели допишут уже переданные записи, и возвращает их состояние по порядку целей
+        markers = []
+        for sink in self.sinks:
+            marker = _CheckpointMarker()
+            if sink.error is None:
+                sink.put(marker, None)
+            else:
+                marker.done.set()
+            markers.append(marker)
+        for marker in markers:
+            marker.done.wait()
+        return [marker.state for marker in markers]
+
+    def close(self, finalize=True):
+        for sink in self.sinks:
+            sink.close(finalize)
+        if not finalize:
+            return
+        # Недописанный архив только запутает восстановление
+        for sink in self.sinks:
+            if sink.error is not None and os.path.exists(sink.partial_path):
+                try:
+                    os.remove(sink.partial_path)
+                except OSError:
+                    pass
+
+
+def _make_decompressor(compress_type):
+    if compress_type == ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    if compress_type == ZIP_BZIP2:
+        return bz2.BZ2Decompressor()
+    if compress_type == ZIP_LZMA:
+        return zipfile.LZMADecompressor()
+    return None
+
+
+def _read_entry_at(archive_path, offset, compress_size, compress_type, crc, out=None, limiter=None):
+    # Читаем запись по смещению локального заголовка, не разбирая центральный каталог архива.
+    # Распакованные данные пишутся в out, если он задан; возвращается их размер
+    with open(archive_path, "rb") as f:
+        f.seek(offset)
+        header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise ValueError(f"Неверный заголовок записи по смещению {offset} в {archive_path}")
+        f.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        decompressor = _make_decompressor(compress_type)
+        actual_crc = 0
+        size = 0
+        remaining = compress_size
+        while remaining > 0:
+            block = f.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError(f"Архив {archive_path} обрезан")
+            if limiter:
+                limiter.consume(len(block))
+            remaining -= len(block)
+            if decompressor:
+                block = decompressor.decompress(block)
+            actual_crc = zlib.crc32(block, actual_crc)
+            size += len(block)
+            if out:
+                out.write(block)
+        if decompressor and hasattr(decompressor, "flush"):
+            block = decompressor.flush()
+            actual_crc = zlib.crc32(block, actual_crc)
+            size += len(block)
+            if out:
+                out.write(block)
+    if actual_crc != crc:
+        raise ValueError("контрольная сумма не совпадает")
+    return size
+
+
+def _extract_entry_at(archive_path, offset, compress_size, compress_type, crc, dest_path):
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    with open(dest_path, "wb") as out:
+        try:
+            _read_entry_at(archive_path, offset, compress_size, compress_type, crc, out)
+        except ValueError as e:
+            raise ValueError(f"{dest_path}: {e}")
+
+
+def _verify_archive(archive_path, workers=1, limiter=None):
+    # Перечитывает все записи архива и сверяет CRC и размер; возвращает список (запись, ошибка).
+    # Нечитаемый центральный каталог - ошибка всего архива
+    try:
+        with ZipFile(archive_path) as zipf:
+            entries = zipf.infolist()
+    except Exception as e:
+        return [("", str(e))]
+
+    def check(zinfo):
+        try:
+            size = _read_entry_at(archive_path, zinfo.header_offset, zinfo.compress_size, zinfo.compress_type,
+                                  zinfo.CRC, limiter=limiter)
+            if size != zinfo.file_size:
+                return zinfo.filename, f"размер {size} вместо {zinfo.file_size}"
+        except Exception as e:
+            return zinfo.filename, str(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return [result for result in pool.map(check, entries) if result]
+
+
+class _ClosingConnection:
+    # sqlite3.Connection как менеджер контекста фиксирует транзакцию, но не закрывает соединение
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+
+
+class BackupCatalog:
+    """SQLite-каталог всех записей архивов задания для поиска и выборочного восстановления."""
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        state_dir = os.path.join(target_dir, STATE_DIR_NAME)
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, CATALOG_FILE)
+        is_new = not os.path.isfile(self.path)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS archives
+                            (id INTEGER PRIMARY KEY, path TEXT UNIQUE, created TEXT, type TEXT)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries
+                            (archive_id INTEGER, arcname TEXT, name TEXT, offset INTEGER,
+                             compress_size INTEGER, file_size INTEGER, mtime REAL, crc INTEGER,
+                             compress_type INTEGER)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_arcname ON entries (arcname)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_name ON entries (name)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_archive ON entries (archive_id)")
+        if is_new:
+            self.index_existing()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        return _ClosingConnection(conn)
+
+    def _relative(self, archive_path):
+        return os.path.relpath(archive_path, self.target_dir).replace(os.sep, "/")
+
+    def add_archive(self, archive_path, meta, infolist, refs=None):
+        rows = []
+        by_name = {}
+        for zinfo in infolist:
+            if zinfo.filename in (ARCHIVE_META_NAME, ARCHIVE_REFS_NAME):
+                continue
+            by_name[zinfo.filename] = zinfo
+            rows.append((zinfo.filename, zinfo.filename.rsplit("/", 1)[-1], zinfo.header_offset,
+                         zinfo.compress_size, zinfo.file_size, time.mktime(zinfo.date_time + (0, 0, -1)),
+                         zinfo.CRC, zinfo.compress_type))
+        # Повтор указывает на данные записанной копии, поэтому ищется и восстанавливается как обычная запись
+        for arcname, original in (refs or {}).items():
+            zinfo = by_name.get(original)
+            if zinfo is not None:
+                rows.append((arcname, arcname.rsplit("/", 1)[-1], zinfo.header_offset,
+                             zinfo.compress_size, zinfo.file_size, time.mktime(zinfo.date_time + (0, 0, -1)),
+                             zinfo.CRC, zinfo.compress_type))
+        self.remove_archive(archive_path)
+        with self._connect() as conn:
+            cursor = conn.execute("INSERT INTO archives (path, created, type) VALUES (?, ?, ?)",
+                                  (self._relative(archive_path), meta.get("created", ""), meta.get("type", "full")))
+            archive_id = cursor.lastrowid
+            conn.executemany("""INSERT INTO entries (archive_id, arcname, name, offset, compress_size, file_size,
+                                                     mtime, crc, compress_type)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             [(archive_id,) + row for row in rows])
+
+    def remove_archive(self, archive_path):
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM archives WHERE path = ?", (self._relative(archive_path),)).fetchone()
+            if row:
+                conn.execute("DELETE FROM entries WHERE archive_id = ?", row)
+                conn.execute("DELETE FROM archives WHERE id = ?", row)
+
+    def index_existing(self):
+        # Архивы, созданные до появления каталога
+        for archive_path in _list_archives(self.target_dir):
+            try:
+                with ZipFile(archive_path) as zipf:
+                    self.add_archive(archive_path, _read_archive_meta(zipf), zipf.infolist(),
+                                     _read_archive_refs(zipf))
+            except Exception as e:
+                logging.warning(f"Архив не добавлен в каталог {archive_path}: {e}")
+
+    def find_versions(self, query, limit=20, columns=("arcname", "name")):
+        # Точное совпадение пути в архиве, иначе - имени файла; новые версии первыми
+        with self._connect() as conn:
+            for column in columns:
+                rows = conn.execute(f"""SELECT a.path, e.arcname, e.offset, e.compress_size, e.file_size,
+                                               e.mtime, e.crc, e.compress_type
+                                        FROM entries e JOIN archives a ON a.id = e.archive_id
+                                        WHERE e.{column} = ? ORDER BY a.path DESC LIMIT ?""",
+                                    (query, limit)).fetchall()
+                if rows:
+                    break
+        return [{"archive": os.path.join(self.target_dir, *row[0].split("/")), "arcname": row[1],
+                 "offset": row[2], "compress_size": row[3], "file_size": row[4], "mtime": row[5],
+                 "crc": row[6], "compress_type": row[7]} for row in rows]
+
+    def restore_latest(self, query, dest_dir):
+        versions = self.find_versions(query, limit=1)
+        if not versions:
+            return None
+        version = versions[0]
+        dest_path = os.path.join(dest_dir, *version["arcname"].split("/"))
+        _extract_entry_at(version["archive"], version["offset"], version["compress_size"],
+                          version["compress_type"], version["crc"], dest_path)
+        # Дельты из архивов новее найденной целой версии применяются к ней по порядку
+        deltas = [v for v in self.find_versions(version["arcname"] + DELTA_SUFFIX, 10000, ("arcname",))
+                  if v["archive"] > version["archive"]]
+        for delta in reversed(deltas):
+            with tempfile.TemporaryFile() as data:
+                _read_entry_at(delta["archive"], delta["offset"], delta["compress_size"],
+                               delta["compress_type"], delta["crc"], data)
+                data.seek(0)
+                _apply_delta(data, dest_path)
+            version = delta
+        return version, dest_path
+
+
+def _read_archive_refs(zipf):
+    try:
+        return json.loads(zipf.read(ARCHIVE_REFS_NAME).decode("utf-8"))
+    except KeyError:
+        return {}
+
+
+def _read_archive_meta(zipf):
+    # Архивы без служебной записи (старые версии) считаются полными
+    try:
+        return json.loads(zipf.read(ARCHIVE_META_NAME).decode("utf-8"))
+    except KeyError:
+        return {"type": "full", "deleted": []}
+
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _prometheus_text(metrics):
+    # Итоги последнего запуска в текстовом формате Prometheus; все значения - gauge
+    job = f'job="{_prometheus_label(metrics["job"])}"'
+    series = [
+        ("backup_last_run_success", "1 - последний запуск завершился успешно", [("", int(metrics["ok"]))]),
+        ("backup_last_run_timestamp_seconds", "Время окончания последнего запуска",
+         [("", metrics["finished"])]),
+        ("backup_last_run_duration_seconds", "Длительность последнего запуска", [("", metrics["duration"])]),
+        ("backup_last_run_phase_seconds", "Время фаз последнего запуска (чтение, сжатие и запись - по всем потокам)",
+         [(f'phase="{phase}"', seconds) for phase, seconds in metrics.get("phases", {}).items()]),
+        ("backup_last_run_files", "Файлы последнего запуска",
+         [(f'state="{state}"', metrics[key]) for state, key in
+          (("found", "files_found"), ("archived", "files_archived"), ("skipped", "files_skipped"),
+           ("deleted", "files_deleted")) if key in metrics]),
+        ("backup_last_run_errors", "Ошибки обхода и чтения файлов", [("", metrics["errors"])]),
+        ("backup_last_run_bytes", "Объём данных последнего запуска",
+         [(f'kind="{kind}"', metrics[key]) for kind, key in
+          (("found", "bytes_found"), ("read", "bytes_read"), ("compressed", "bytes_compressed")) if key in metrics]),
+        ("backup_last_run_written_bytes", "Записано в цель",
+         [(f'target="{_prometheus_label(target)}"', size)
+          for target, size in metrics.get("bytes_written", {}).items()]),
+        ("backup_last_run_compression_ratio", "Доля сжатого объёма от исходного",
+         [("", metrics["compression_ratio"])] if "compression_ratio" in metrics else []),
+    ]
+    lines = []
+    for name, help_text, samples in series:
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{{{job}{',' + labels if labels else ''}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class BackupEngine:
+    """Движок резервного копирования без зависимостей от интерфейса.
+
+    Используется окном BackupApp и консольным режимом. Сообщения передаются через
+    методы _log и _show_notification, которые переопределяет интерфейс, а ход
+    текущего запуска доступен в current_progress для опроса из любого потока.
+    """
+
+    def __init__(self):
+        self.source_dirs = []
+        self.source_files = []
+        self.exclude_patterns = []
+        self.target_dir = ""
+        # Дополнительные цели: каждый файл читается и сжимается один раз и пишется во все цели
+        self.mirror_dirs = []
+        self.interval_hours = 24
+        self.interval_weeks = 0
+        self.compression_level = 6
+        self.backup_mode = "full"
+        self.full_backup_every = 7
+        self.hash_files = False
+        self.compression_workers = os.cpu_count() or 1
+        self.codec_rules = {}
+        # Файлы от delta_min_size_mb (0 - выключено) в инкрементальных копиях хранятся дельтами блоков
+        # по delta_block_kb; после delta_max_chain дельт подряд файл снова пишется целиком
+        self.delta_min_size_mb = 0
+        self.delta_block_kb = 256
+        self.delta_max_chain = 7
+        # Файлы от dedup_min_size_kb (0 - выключено) с одинаковым содержимым пишутся в архив один раз
+        self.dedup_min_size_kb = 0
+        # Режим "snapshot": клонировать неизменённые файлы (FICLONE) вместо жёстких ссылок
+        self.snapshot_reflink = False
+        # 0 - без ограничений по соответствующему уровню
+        self.retention_daily = 0
+        self.retention_weekly = 0
+        self.retention_monthly = 0
+        # Ограничения нагрузки: МБ/с (0 - без ограничения), окна расписания, открытые файлы
+        self.read_limit_mbps = 0
+        self.throttle_schedule = []
+        self.max_open_files = 0
+        self.low_priority = False
+        # Повторы чтения изменившихся во время чтения файлов и маски файлов, копируемых перед сжатием
+        self.consistency_retries = 3
+        self.staging_patterns = []
+        # Наблюдение за изменениями (inotify): между полными проходами изменения сбрасываются в малые архивы
+        self.watch_changes = False
+        self.watch_flush_seconds = 60
+        # Проверка архивов: сразу после записи и фоновая перепроверка старых (0 - выключена)
+        self.verify_backups = True
+        self.scrub_interval_hours = 0
+        self.scrub_read_mbps = 10
+        self.log_verbosity = "info"
+        # Несколько заданий со своими источниками, целями и расписанием; пусто - одно задание из настроек выше.
+        # Каждое задание - словарь, переопределяющий общие настройки
+        self.jobs = []
+        self.max_concurrent_jobs = 1
+        self.global_read_limit_mbps = 0
+        # Оценка размера и длительности перед каждым плановым запуском, см. PREFLIGHT_POLICIES.
+        # По умолчанию только предупреждает: обход выборки ограничен PREFLIGHT_MAX_SECONDS
+        self.preflight_policy = "warn"
+        # Каталог textfile-коллектора node_exporter для метрик запусков; пусто - не писать
+        self.metrics_dir = ""
+        # Имя задания в метриках; у заданий планировщика - из их настроек
+        self.name = "default"
+        self.shared_limiter = None
+        self.backup_thread = None
+        self.stop_event = threading.Event()
+        self.next_backup_time = None
+        self.current_progress = None
+
+    # --- События ---
+    def _log(self, message, level=logging.INFO):
+        if level >= LOG_LEVELS.get(self.log_verbosity, logging.INFO):
+            self._write_log(message, level)
+
+    def _write_log(self, message, level):
+        # Вывод без фильтра по подробности: задания планировщика фильтруют свои сообщения сами
+        logging.log(level, message)
+
+    def _show_notification(self, message):
+        pass
+
+    # --- Настройки ---
+    def load_settings(self, path=SETTINGS_FILE):
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.apply_settings(json.load(f))
+            self._log("Настройки загружены")
+            return True
+        except Exception as e:
+            self._log(f"Ошибка при загрузке настроек: {e}")
+            return False
+
+    def apply_settings(self, settings):
+        self.source_dirs = settings.get("source_dirs", [])
+        self.source_files = settings.get("source_files", [])
+        # target_dir может быть списком: первая цель основная, остальные - копии
+        target = settings.get("target_dir", "")
+        if isinstance(target, list):
+            self.target_dir, self.mirror_dirs = (target[0] if target else ""), target[1:]
+        else:
+            self.target_dir, self.mirror_dirs = target, []
+        self.interval_hours = settings.get("interval_hours", 1)
+        self.interval_weeks = settings.get("interval_weeks", 0)
+        self.compression_level = settings.get("compression_level", 6)
+        self.exclude_patterns = settings.get("exclude_patterns", [])
+        self.backup_mode = settings.get("backup_mode", "full")
+        self.full_backup_every = settings.get("full_backup_every", 7)
+        self.hash_files = settings.get("hash_files", False)
+        self.compression_workers = settings.get("compression_workers", os.cpu_count() or 1)
+        self.codec_rules = settings.get("codec_rules", {})
+        self.delta_min_size_mb = settings.get("delta_min_size_mb", 0)
+        self.delta_block_kb = settings.get("delta_block_kb", 256)
+        self.delta_max_chain = settings.get("delta_max_chain", 7)
+        self.dedup_min_size_kb = settings.get("dedup_min_size_kb", 0)
+        self.snapshot_reflink = settings.get("snapshot_reflink", False)
+        self.retention_daily = settings.get("retention_daily", 0)
+        self.retention_weekly = settings.get("retention_weekly", 0)
+        self.retention_monthly = settings.get("retention_monthly", 0)
+        self.read_limit_mbps = settings.get("read_limit_mbps", 0)
+        self.throttle_schedule = settings.get("throttle_schedule", [])
+        self.max_open_files = settings.get("max_open_files", 0)
+        self.low_priority = settings.get("low_priority", False)
+        self.consistency_retries = settings.get("consistency_retries", 3)
+        self.staging_patterns = settings.get("staging_patterns", [])
+        self.watch_changes = settings.get("watch_changes", False)
+        self.watch_flush_seconds = settings.get("watch_flush_seconds", 60)
+        self.verify_backups = settings.get("verify_backups", True)
+        self.scrub_interval_hours = settings.get("scrub_interval_hours", 0)
+        self.scrub_read_mbps = settings.get("scrub_read_mbps", 10)
+        self.log_verbosity = settings.get("log_verbosity", "info")
+        self.jobs = settings.get("jobs", [])
+        self.max_concurrent_jobs = settings.get("max_concurrent_jobs", 1)
+        self.global_read_limit_mbps = settings.get("global_read_limit_mbps", 0)
+        self.metrics_dir = settings.get("metrics_dir", "")
+        self.preflight_policy = settings.get("preflight_policy", "warn")
+
+    def settings_dict(self):
+        return {
+            "source_dirs": self.source_dirs,
+            "source_files": self.source_files,
+            "target_dir": [self.target_dir] + self.mirror_dirs if self.mirror_dirs else self.target_dir,
+            "interval_hours": self.interval_hours,
+            "interval_weeks": self.interval_weeks,
+            "compression_level": self.compression_level,
+            "exclude_patterns": self.exclude_patterns,
+            "backup_mode": self.backup_mode,
+            "full_backup_every": self.full_backup_every,
+            "hash_files": self.hash_files,
+            "compression_workers": self.compression_workers,
+            "codec_rules": self.codec_rules,
+            "delta_min_size_mb": self.delta_min_size_mb,
+            "delta_block_kb": self.delta_block_kb,
+            "delta_max_chain": self.delta_max_chain,
+            "dedup_min_size_kb": self.dedup_min_size_kb,
+            "snapshot_reflink": self.snapshot_reflink,
+            "retention_daily": self.retention_daily,
+            "retention_weekly": self.retention_weekly,
+            "retention_monthly": self.retention_monthly,
+            "read_limit_mbps": self.read_limit_mbps,
+            "throttle_schedule": self.throttle_schedule,
+            "max_open_files": self.max_open_files,
+            "low_priority": self.low_priority,
+            "consistency_retries": self.consistency_retries,
+            "staging_patterns": self.staging_patterns,
+            "watch_changes": self.watch_changes,
+            "watch_flush_seconds": self.watch_flush_seconds,
+            "verify_backups": self.verify_backups,
+            "scrub_interval_hours": self.scrub_interval_hours,
+            "scrub_read_mbps": self.scrub_read_mbps,
+            "log_verbosity": self.log_verbosity,
+            "jobs": self.jobs,
+            "max_concurrent_jobs": self.max_concurrent_jobs,
+            "global_read_limit_mbps": self.global_read_limit_mbps,
+            "metrics_dir": self.metrics_dir,
+            "preflight_policy": self.preflight_policy,
+        }
+
+    def save_settings(self, path=SETTINGS_FILE, backup_path=SETTINGS_BACKUP_FILE):
+        settings = self.settings_dict()
+        # Резервное копирование файла настроек
+        try:
+            if os.path.isfile(path):
+                shutil.copy2(path, backup_path)
+        except Exception as e:
+            self._log(f"Ошибка при создании резервной копии настроек: {e}")
+
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(settings, f, ensure_ascii=False, indent=2)
+            self._log("Настройки сохранены")
+        except Exception as e:
+            self._log(f"Ошибка при сохранении настроек: {e}")
+
+    def check_paths(self):
+        # Текст ошибки или None, если источники и целевой каталог в порядке
+        if self.jobs:
+            return self._check_jobs()
+        if not self.source_dirs and not self.source_files:
+            return "Не выбран ни один исходный каталог или файл"
+        for d in self.source_dirs:
+            if not os.path.isdir(d):
+                return f"Исходный каталог не существует:\n{d}"
+        for f in self.source_files:
+            if not os.path.isfile(f):
+                return f"Исходный файл не существует:\n{f}"
+        if not os.path.isdir(self.target_dir):
+            return "Каталог для резервных копий не выбран или не существует"
+        return None
+
+    def start_schedule(self):
+        self.stop_event.clear()
+        self.backup_thread = threading.Thread(target=self.run_backup_schedule, daemon=True)
+        self.backup_thread.start()
+
+    def stop_schedule(self):
+        self.stop_event.set()
+        if self.backup_thread and self.backup_thread.is_alive():
+            self.backup_thread.join()
+
+    # --- Основной цикл резервного копирования ---
+    def _interval_seconds(self):
+        interval_seconds = (self.interval_weeks * 7 * 24 + self.interval_hours) * 3600
+        return interval_seconds if interval_seconds > 0 else 3600
+
+    def run_once(self):
+        # Однократный запуск: все задания по очереди или единственное задание из настроек
+        if not self.jobs:
+            self.create_backup()
+            return
+        for job in self._build_jobs():
+            if self.stop_event.is_set():
+                break
+            try:
+                job.create_backup()
+            except Exception as e:
+                job._log(f"Ошибка в процессе создания резервной копии: {e}")
+
+    def run_backup_schedule(self):
+        if self.jobs:
+            JobScheduler(self, self._build_jobs()).run()
+            return
+        interval_seconds = self._interval_seconds()
+
+        # Наблюдатель запускается до первого прохода, чтобы не пропустить изменения во время него
+        watcher = self._start_watcher() if self.watch_changes else None
+        scrub_thread = None
+        if self.scrub_interval_hours > 0:
+            scrub_thread = threading.Thread(target=self.run_scrub_schedule, daemon=True)
+            scrub_thread.start()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.create_backup()
+                except Exception as e:
+                    self._log(f"Ошибка в процессе создания резервной копии: {e}")
+                # Обновляем время следующего запуска
+                self.next_backup_time = time.time() + interval_seconds
+                if watcher:
+                    if self._watch_until(watcher, self.next_backup_time):
+                        break
+                elif self.stop_event.wait(interval_seconds):
+                    break
+        finally:
+            if watcher:
+                watcher.close()
+            if scrub_thread:
+                scrub_thread.join()
+
+    # --- Проверка архивов ---
+    def run_scrub_schedule(self):
+        # Первая перепроверка - через интервал, чтобы не мешать первому копированию
+        while not self.stop_event.wait(self.scrub_interval_hours * 3600):
+            try:
+                self.scrub_archives()
+            except Exception as e:
+                self._log(f"Ошибка при проверке архивов: {e}")
+
+    def scrub_archives(self):
+        # Перечитывает архивы всех целей, начиная с давно не проверявшихся, с ограничением скорости чтения.
+        # Прерванная остановкой проверка продолжится с того же места
+        return Throttle(low_priority=self.low_priority).run_lowered(self._scrub_archives)
+
+    def _scrub_archives(self):
+        state_path = os.path.join(self.target_dir, STATE_DIR_NAME, SCRUB_STATE_FILE)
+        state = {"verified": {}, "corrupt": {}}
+        if os.path.isfile(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    state.update(json.load(f))
+            except Exception as e:
+                self._log(f"Ошибка при чтении состояния проверки, проверка начнётся заново: {e}")
+        archives = [a for target in self._target_dirs() for a in _list_archives(target)]
+        existing = set(archives)
+        for key in ("verified", "corrupt"):
+            state[key] = {a: v for a, v in state[key].items() if a in existing}
+        archives.sort(key=lambda a: state["verified"].get(a, 0))
+
+        limiter = RateLimiter(self.scrub_read_mbps * 1024 * 1024)
+        checked = 0
+        corrupt = []
+        for path in archives:
+            if self.stop_event.is_set():
+                break
+            errors = _verify_archive(path, 1, limiter)
+            if errors and not os.path.exists(path):
+                continue  # архив удалила политика хранения
+            checked += 1
+            state["verified"][path] = time.time()
+            if errors:
+                corrupt.append(path)
+                state["corrupt"][path] = [f"{name}: {error}" if name else error for name, error in errors]
+                self._log(f"Архив повреждён: {path} ({len(errors)} записей, "
+                          f"первая: {errors[0][0] or 'каталог архива'}: {errors[0][1]})", logging.ERROR)
+            else:
+                state["corrupt"].pop(path, None)
+            try:
+                os.makedirs(os.path.dirname(state_path), exist_ok=True)
+                _write_json_atomic(state_path, state)
+            except Exception as e:
+                self._log(f"Ошибка при сохранении состояния проверки: {e}")
+        self._log(f"Проверка архивов: проверено {checked} из {len(archives)}, повреждено {len(corrupt)}, "
+                  f"прочитано {limiter.bytes_total / 1024 / 1024:.1f} МБ")
+        if corrupt:
+            self._show_notification(f"Обнаружены повреждённые архивы: {len(corrupt)}")
+        return corrupt
+
+    def _verify_new_archives(self, sinks):
+        # Свежие архивы перечитываются пулом потоков; не прошедший проверку архив считается
+        # несостоявшимся для своей цели и переименовывается, чтобы не попасть в цепочку восстановления
+        for sink in sinks:
+            if sink.error is not None:
+                continue
+            started = time.monotonic()
+            errors = _verify_archive(sink.archive_path, self.compression_workers)
+            if not errors:
+                self._log(f"Архив проверен: {sink.archive_path} ({time.monotonic() - started:.1f} с)", logging.DEBUG)
+                continue
+            name, error = errors[0]
+            sink.error = ValueError(f"проверка не пройдена ({len(errors)} записей, {name or 'каталог архива'}: {error})")
+            try:
+                os.replace(sink.archive_path, sink.archive_path + CORRUPT_SUFFIX)
+            except OSError as e:
+                self._log(f"Не удалось переименовать повреждённый архив {sink.archive_path}: {e}")
+
+    # --- Несколько заданий ---
+    def _build_jobs(self):
+        # Задание наследует общие настройки и переопределяет нужные; стоп-сигнал и общий лимит чтения у всех один
+        base = self.settings_dict()
+        base.update(jobs=[])
+        if self.global_read_limit_mbps > 0 and self.shared_limiter is None:
+            self.shared_limiter = RateLimiter(self.global_read_limit_mbps * 1024 * 1024)
+        jobs = []
+        for index, overrides in enumerate(self.jobs):
+            job = _JobEngine(self, overrides.get("name") or f"задание {index + 1}")
+            job.apply_settings({**base, **overrides, "jobs": []})
+            job.stop_event = self.stop_event
+            job.shared_limiter = self.shared_limiter
+            jobs.append(job)
+        return jobs
+
+    def _check_jobs(self):
+        targets = {}
+        for job in self._build_jobs():
+            error = job.check_paths()
+            if error:
+                return f"Задание «{job.name}»: {error}"
+            # Манифест и итоги запусков лежат в целевом каталоге, делить его заданиям нельзя
+            for target in job._target_dirs():
+                key = os.path.normcase(os.path.abspath(target))
+                if key in targets:
+                    return f"Задания «{targets[key]}» и «{job.name}» пишут в один каталог:\n{target}"
+                targets[key] = job.name
+        return None
+
+    # --- Наблюдение за изменениями ---
+    def _start_watcher(self):
+        if not sys.platform.startswith("linux"):
+            self._log("Наблюдение за изменениями доступно только в Linux, используется обычное расписание")
+            return None
+        if self.backup_mode in ("repository", "snapshot"):
+            self._log("В режимах репозитория и снимков наблюдение за изменениями не используется")
+            return None
+        sources = self._watch_sources()
+        file_dirs = {os.path.dirname(os.path.normpath(f)) for f in self.source_files}
+        watcher = None
+        try:
+            watcher = InotifyWatcher(lambda path: path in file_dirs
+                                     or self._resolve_watched(sources, path, True) is not None)
+            for source_dir, _name, _rules in sources:
+                watcher.add_tree(source_dir)
+            for folder in file_dirs:
+                watcher.add_tree(folder)
+        except Exception as e:
+            # Обычно это нехватка fs.inotify.max_user_watches на больших деревьях
+            self._log(f"Не удалось включить наблюдение за изменениями, используется обычное расписание: {e}")
+            if watcher:
+                watcher.close()
+            return None
+        self._log(f"Наблюдение за изменениями включено (каталогов: {watcher.watch_count})")
+        return watcher
+
+    def _watch_until(self, watcher, deadline):
+        # Сбрасывает накопленные изменения в малые архивы до срока полного прохода.
+        # Возвращает True, если получен сигнал остановки
+        flush_seconds = max(self.watch_flush_seconds, WATCH_MIN_FLUSH_SECONDS)
+        next_flush = time.time() + flush_seconds
+        while time.time() < deadline:
+            if self.stop_event.is_set():
+                return True
+            watcher.poll(min(1.0, max(0.0, next_flush - time.time())))
+            if time.time() < next_flush:
+                continue
+            next_flush = time.time() + flush_seconds
+            changed, overflow = watcher.take_changes()
+            if overflow:
+                self._log("Часть событий об изменениях потеряна, выполняется полное сканирование", logging.WARNING)
+                return self.stop_event.is_set()
+            if changed:
+                try:
+                    self.create_backup(changed)
+                except Exception as e:
+                    self._log(f"Ошибка при сохранении изменений: {e}")
+        return self.stop_event.is_set()
+
+    def _watch_sources(self):
+        sources = []
+        for source_dir in self.source_dirs:
+            try:
+                rules = ExcludeRules.for_source(self.exclude_patterns, source_dir)
+            except Exception as e:
+                self._log(f"Ошибка в правилах исключения для {source_dir}: {e}")
+                continue
+            source_dir = os.path.normpath(source_dir)
+            sources.append((source_dir, os.path.basename(source_dir), rules))
+        return sources
+
+    def _resolve_watched(self, sources, path, is_dir):
+        # (путь, имя в архиве, путь от корня источника, имя источника, правила) или None,
+        # если путь не входит в источники или исключён. Для отдельных файлов путь от корня - None
+        path = os.path.normpath(path)
+        for target in self._target_dirs():
+            target = os.path.normpath(target) if target else None
+            if target and (path == target or path.startswith(target + os.sep)):
+                return None
+        for source_dir, name, rules in sources:
+            if path == source_dir:
+                return path, name, "", name, rules
+            if path.startswith(source_dir + os.sep):
+                rel = os.path.relpath(path, source_dir).replace(os.sep, "/")
+                parts = rel.split("/")
+                if rules and (rules.is_excluded(rel, is_dir)
+                              or any(rules.is_excluded("/".join(parts[:i]), True) for i in range(1, len(parts)))):
+                    return None
+                return path, name + "/" + rel, rel, name, rules
+        if path in {os.path.normpath(f) for f in self.source_files}:
+            filename = os.path.basename(path)
+            if ExcludeRules(self.exclude_patterns).is_excluded(filename):
+                return None
+            return path, "files/" + filename, None, None, None
+        return None
+
+    def _resolve_changes(self, changed_paths):
+        # Вложенные пути отбрасываются: изменённый каталог и так пересканируется целиком
+        sources = self._watch_sources()
+        resolved = []
+        for path in changed_paths:
+            item = self._resolve_watched(sources, path, os.path.isdir(path))
+            if item is not None:
+                resolved.append(item)
+        resolved.sort(key=lambda item: item[1])
+        kept = set()
+        targets = []
+        for item in resolved:
+            parts = item[1].split("/")
+            if any("/".join(parts[:i]) in kept for i in range(1, len(parts))):
+                continue
+            kept.add(item[1])
+            targets.append(item)
+        return targets
+
+    def _scan_changes(self, targets, progress):
+        for path, arcname, rel, source_dir_name, rules in targets:
+            try:
+                if rel is not None and os.path.isdir(path) and not os.path.islink(path):
+                    yield from self._scan_tree(path, rel + "/" if rel else "", source_dir_name, rules, progress)
+                elif os.path.isfile(path):
+                    st = os.stat(path)
+                    progress.found(st.st_size)
+                    yield path, arcname, st
+            except OSError as e:
+                self._log(f"Ошибка при чтении атрибутов {path}: {e}")
+                progress.error()
+
+    # --- Создание резервной копии ---
+    def create_backup(self, changed_paths=None):
+        # changed_paths - пути от наблюдателя: в архив попадают только они
+        if changed_paths is None and not self._preflight_check():
+            return
+        if changed_paths is None:
+            # Старые копии удаляются до начала записи, чтобы запуск не упёрся в заполненный диск
+            self._apply_retention()
+
+        throttle = Throttle(self.read_limit_mbps, self.throttle_schedule, self.max_open_files, self.low_priority,
+                            self.shared_limiter)
+        throttle.run_lowered(self._run_backup, throttle, changed_paths)
+
+    def _run_backup(self, throttle, changed_paths):
+        try:
+            if self.backup_mode == "repository":
+                self._create_repository_snapshot(throttle)
+            elif self.backup_mode == "snapshot":
+                self._create_link_snapshot(throttle)
+            else:
+                self._create_zip_backup(throttle, changed_paths)
+        finally:
+            self._log_throttle_stats(throttle)
+
+    def _create_zip_backup(self, throttle, changed_paths=None):
+        # Имя архива - время с точностью до секунды; частые сбросы изменений не должны его перезаписать.
+        # Во всех целях архив лежит по одному и тому же относительному пути
+        targets = self._target_dirs()
+        # Пока есть прерванный запуск, сбросы изменений не создаются: сначала он должен завершиться
+        if changed_paths is not None and os.path.isfile(self._checkpoint_path()):
+            changed_paths = None
+        checkpoint = self._take_checkpoint() if changed_paths is None else None
+        if checkpoint:
+            archive_rel = checkpoint["archive"]
+            # Цель без своего состояния в контрольной точке продолжить нельзя, она пропускает этот запуск
+            resume_states = [checkpoint["targets"].get(t, {}) for t in targets]
+            self._log(f"Продолжение прерванного запуска: {archive_rel} "
+                      f"(уже в архиве файлов: {len(checkpoint['files'])})")
+        else:
+            resume_states = None
+            while True:
+                archive_rel = time.strftime("%Y%m%d") + "/" + time.strftime("%H%M%S") + ".zip"
+                if not any(os.path.exists(os.path.join(t, *archive_rel.split("/")) + suffix)
+                           for t in targets for suffix in ("", PARTIAL_SUFFIX)):
+                    break
+                time.sleep(0.2)
+        archive_path = os.path.join(self.target_dir, *archive_rel.split("/"))
+        backup_dir = os.path.dirname(archive_path)
+        if not os.path.exists(backup_dir):
+            try:
+                os.makedirs(backup_dir)
+                self._log(f"Создан каталог для резервных копий: {backup_dir}")
+            except Exception as e:
+                self._log(f"Ошибка при создании каталога резервных копий: {e}")
+                self._show_notification(f"Ошибка при создании каталога: {e}")
+                return
+
+        manifest = self._load_manifest()
+        # Без манифеста сравнивать не с чем - нужен полный проход; после сбоя одной из целей
+        # её цепочка инкрементальных копий разорвана, и полная копия нужна всем целям
+        force_full = manifest.get("force_full", False)
+        changes_only = changed_paths is not None and bool(manifest["files"]) and not force_full
+        if changes_only:
+            incremental = True
+            old_files = manifest["files"]
+            changed = self._resolve_changes(changed_paths)
+            # Записи изменённых путей пересобираются заново, остальные переносятся как есть;
+            # не найденные при повторном обходе попадут в надгробия
+            prefixes = tuple(item[1] + "/" for item in changed)
+            covered = {item[1] for item in changed}
+            new_files = {a: e for a, e in old_files.items() if a not in covered and not a.startswith(prefixes)}
+            progress = self._new_progress(use_last_run=False)
+            items = self._scan_changes(changed, progress)
+        else:
+            if checkpoint:
+                incremental = checkpoint["incremental"]
+            else:
+                incremental = self._next_run_incremental(manifest)
+            old_files = manifest["files"] if incremental else {}
+            new_files = {}
+            if not incremental and not checkpoint:
+                # Полная копия пишет большие файлы целиком и заново собирает их подписи
+                shutil.rmtree(os.path.join(self.target_dir, STATE_DIR_NAME, SIGNATURES_DIR_NAME), ignore_errors=True)
+            progress = self._new_progress()
+            items = self._iter_backup_files(progress, throttle)
+
+        committed = checkpoint["files"] if checkpoint else {}
+        # Файлы, записанные дельтой до прерывания: их записи "<путь>.bkdelta" уже в архиве
+        committed_deltas = checkpoint.get("deltas", []) if checkpoint else []
+        # None - итоги не выгружаются (запуск прерван или сброс изменений оказался пустым)
+        metrics = {}
+        run_ok = False
+
+        try:
+            compression = ZIP_DEFLATED if self.compression_level > 0 else ZIP_STORED
+            archives = ZipFanout([os.path.join(t, *archive_rel.split("/")) for t in targets], compression,
+                                 self.compression_level if compression == ZIP_DEFLATED else None,
+                                 max(1, self.compression_workers) * 2, resume_states)
+            finalize = True
+            try:
+                policy = CodecPolicy(self.compression_level, self.codec_rules)
+                staging = ExcludeRules(self.staging_patterns) if self.staging_patterns else None
+                duplicates = (_DuplicateFinder(self.dedup_min_size_kb * 1024)
+                              if self.dedup_min_size_kb > 0 else None)
+                writer = ParallelZipWriter(archives, self.compression_workers, policy, throttle,
+                                           self.consistency_retries, staging, duplicates)
+
+                interrupted = False
+                last_checkpoint = time.monotonic()
+                try:
+                    for filepath, arcname, st in items:
+                        if not changes_only and self.stop_event.is_set():
+                            interrupted = True
+                            break
+                        if arcname in committed:
+                            # Файл записан в архив до прерывания и повторно не читается
+                            new_files[arcname] = committed[arcname]
+                        else:
+                            self._backup_file(writer, filepath, arcname, st, old_files, new_files, throttle)
+
+                        progress.done(st.st_size)
+                        if not changes_only and time.monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                            self._save_checkpoint(archive_rel, incremental, targets, archives, new_files,
+                                                  committed_deltas + writer.deltas)
+                            last_checkpoint = time.monotonic()
+                finally:
+                    writer.close()
+                if interrupted:
+                    self._save_checkpoint(archive_rel, incremental, targets, archives, new_files,
+                                          committed_deltas + writer.deltas)
+                    finalize = False
+                    metrics = None
+                    self._log(f"Запуск прерван, следующий запуск продолжит архив {archive_rel}")
+                    return
+                total_files = writer.written + len(writer.refs) + sum(1 for a in committed if a in new_files)
+
+                # Удалённые с прошлого запуска файлы фиксируем списком-надгробием
+                deleted = sorted(set(old_files) - set(new_files))
+                meta = {
+                    "type": "incremental" if incremental else "full",
+                    "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "files": total_files,
+                    "deleted": deleted,
+                }
+                if changes_only:
+                    meta["changes_only"] = True
+                if checkpoint:
+                    meta["resumed"] = True
+                if writer.inconsistent:
+                    meta["inconsistent"] = writer.inconsistent
+                if committed_deltas or writer.deltas:
+                    meta["deltas"] = committed_deltas + writer.deltas
+                if writer.refs:
+                    archives.writestr(ARCHIVE_REFS_NAME, json.dumps(writer.refs, ensure_ascii=False))
+                archives.writestr(ARCHIVE_META_NAME, json.dumps(meta, ensure_ascii=False, indent=2))
+            finally:
+                archives.close(finalize)
+            # Недописанных архивов больше нет: они переименованы или удалены
+            if not changes_only:
+                self._drop_checkpoint()
+
+            verify_started = time.monotonic()
+            if self.verify_backups:
+                self._verify_new_archives(archives.sinks)
+            # Время фаз: обход и проверка - по часам, чтение, сжатие и запись - суммарно по потокам.
+            # Ожидание: основной поток ждал сжатия (упор в CPU или чтение) или места в очереди цели (упор в запись)
+            phases = {"scan": progress.scan_time, "read": writer.read_time, "compress": writer.compress_time,
+                      "write": sum(sink.busy_time for sink in archives.sinks),
+                      "wait_compress": writer.wait_time,
+                      "wait_write": archives.wait_time + sum(sink.wait_time for sink in archives.sinks),
+                      "verify": time.monotonic() - verify_started,
+                      "total": time.monotonic() - progress.started}
+            phases = {name: round(seconds, 3) for name, seconds in phases.items()}
+            target_stats = self._log_target_stats(targets, archives.sinks)
+            bytes_in = sum(stat["bytes_in"] for stat in policy.stats.values())
+            bytes_out = sum(stat["bytes_out"] for stat in policy.stats.values())
+            metrics = {
+                "type": "changes" if changes_only else meta["type"],
+                "files_archived": total_files,
+                # Неизменённые файлы, перенесённые в манифест без чтения
+                "files_skipped": sum(1 for a, e in new_files.items() if old_files.get(a) is e),
+                "files_deleted": len(deleted),
+                "files_deduplicated": len(writer.refs),
+                "bytes_in": bytes_in,
+                "bytes_compressed": bytes_out,
+                "compression_ratio": round(bytes_out / bytes_in, 4) if bytes_in else 1.0,
+                "bytes_written": {t: sink.bytes_written for t, sink in zip(targets, archives.sinks)},
+                "phases": phases,
+            }
+            failed = [sink for sink in archives.sinks if sink.error is not None]
+            primary = archives.sinks[0]
+            if primary.error is not None:
+                # Манифест описывает содержимое основной цели: без её архива он не меняется
+                manifest["force_full"] = True
+                self._save_manifest(manifest)
+                raise primary.error
+
+            manifest["files"] = new_files
+            manifest["force_full"] = bool(failed)
+            if changes_only:
+                self._save_manifest(manifest)
+                # События без изменения содержимого (touch, chmod) пустых архивов не оставляют
+                if not total_files and not deleted:
+                    for sink in archives.sinks:
+                        if sink.error is None:
+                            os.remove(sink.archive_path)
+                    self._log("Изменений содержимого нет, архив не создан", logging.DEBUG)
+                    metrics = None
+                    return
+            else:
+                # Сбросы изменений не приближают очередную полную копию: их может быть много за день
+                manifest["incrementals_since_full"] = manifest["incrementals_since_full"] + 1 if incremental else 0
+                self._save_manifest(manifest)
+                self._save_last_run(progress, policy.stats, writer.consistency_stats(), target_stats, phases)
+                self._log_codec_stats(policy.stats)
+            self._update_ratios(policy.extensions)
+            self._log_consistency_stats(writer)
+            if writer.deltas:
+                self._log(f"Дельты: файлов {len(writer.deltas)}, изменено блоков {writer.delta_blocks_changed} "
+                          f"из {writer.delta_blocks_total}")
+            if writer.refs:
+                self._log(f"Повторы: файлов {len(writer.refs)} записаны ссылками, "
+                          f"не записано {writer.bytes_deduplicated / 1024 / 1024:.1f} МБ")
+
+            for target, sink in zip(targets, archives.sinks):
+                if sink.error is not None:
+                    continue
+                try:
+                    BackupCatalog(target).add_archive(sink.archive_path, meta, sink.entries, writer.refs)
+                except Exception as e:
+                    self._log(f"Ошибка при обновлении каталога в {target}: {e}")
+
+            if changes_only:
+                self._log(f"Изменения сохранены: {archive_path} (файлов: {total_files}, удалено: {len(deleted)})")
+            else:
+                kind = "Инкрементальная" if incremental else "Полная"
+                self._log(f"{kind} резервная копия создана: {archive_path} (файлов: {total_files}, удалено: {len(deleted)})")
+                self._show_notification(f"Резервная копия создана: {archive_path} (файлов: {total_files})")
+            if failed:
+                self._show_notification(f"Не удалось записать копию в целей: {len(failed)}, "
+                                        "следующий запуск будет полным")
+            run_ok = True
+        except Exception as e:
+            self._log(f"Ошибка при создании резервной копии: {e}")
+            self._show_notification(f"Ошибка при создании резервной копии: {e}")
+        finally:
+            progress.finish()
+            if metrics is not None:
+                self._export_metrics(progress, throttle, run_ok, metrics)
+
+    def _next_run_incremental(self, manifest):
+        return bool(self.backup_mode == "incremental" and manifest["files"] and not manifest.get("force_full")
+                    and manifest["incrementals_since_full"] < self.full_backup_every)
+
+    # --- Контрольные точки прерванного запуска ---
+    def _checkpoint_path(self):
+        return os.path.join(self.target_dir, STATE_DIR_NAME, CHECKPOINT_FILE)
+
+    def _checkpoint_key(self):
+        # Продолжить можно только запуск с теми же источниками, целями и режимом
+        return {"source_dirs": self.source_dirs, "source_files": self.source_files,
+                "targets": self._target_dirs(), "backup_mode": self.backup_mode}
+
+    def _take_checkpoint(self):
+        # Возвращает подходящую контрольную точку или None. Недописанные архивы,
+        # которые нельзя продолжить, удаляются
+        checkpoint = None
+        path = self._checkpoint_path()
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    checkpoint = json.load(f)
+            except Exception as e:
+                self._log(f"Ошибка при чтении контрольной точки: {e}")
+        targets = self._target_dirs()
+        if checkpoint:
+            partial = os.path.join(self.target_dir, *checkpoint["archive"].split("/")) + PARTIAL_SUFFIX
+            if checkpoint.get("key") != self._checkpoint_key() or not os.path.isfile(partial):
+                self._log("Контрольная точка прерванного запуска не подходит к текущим настройкам и отброшена")
+                # Недописанные архивы остались и в целях, которые с тех пор убраны из настроек
+                targets += [t for t in checkpoint.get("key", {}).get("targets", []) if t not in targets]
+                checkpoint = None
+        for target in targets:
+            keep = os.path.join(target, *checkpoint["archive"].split("/")) + PARTIAL_SUFFIX if checkpoint else None
+            for partial in _list_archives(target, PARTIAL_SUFFIX):
+                if partial == keep:
+                    continue
+                try:
+                    os.remove(partial)
+                    self._log(f"Удалён недописанный архив: {partial}")
+                except OSError as e:
+                    self._log(f"Не удалось удалить недописанный архив {partial}: {e}")
+        if checkpoint is None:
+            self._drop_checkpoint()
+        return checkpoint
+
+    def _save_checkpoint(self, archive_rel, incremental, targets, archives, new_files, deltas):
+        states = archives.checkpoint()
+        if states[0] is None:
+            return  # основная цель уже не пишется, продолжать нечего
+        # Файл, записанный дельтой, лежит в архиве под именем "<путь>.bkdelta"
+        delta_entries = {arcname + DELTA_SUFFIX: arcname for arcname in deltas}
+        written = {delta_entries.get(entry["name"], entry["name"]) for entry in states[0]["entries"]}
+        checkpoint = {
+            "key": self._checkpoint_key(),
+            "archive": archive_rel,
+            "incremental": incremental,
+            "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "targets": {t: state for t, state in zip(targets, states) if state},
+            "files": {a: e for a, e in new_files.items() if a in written},
+            "deltas": [a for a in deltas if a in written and a in new_files],
+        }
+        try:
+            os.makedirs(os.path.dirname(self._checkpoint_path()), exist_ok=True)
+            _write_json_atomic(self._checkpoint_path(), checkpoint)
+            self._log(f"Контрольная точка: в архиве файлов {len(checkpoint['files'])}", logging.DEBUG)
+        except Exception as e:
+            self._log(f"Ошибка при сохранении контрольной точки: {e}")
+
+    def _drop_checkpoint(self):
+        try:
+            if os.path.isfile(self._checkpoint_path()):
+                os.remove(self._checkpoint_path())
+        except OSError as e:
+            self._log(f"Ошибка при удалении контрольной точки: {e}")
+
+    def _target_dirs(self):
+        # Основная цель (манифест, итоги запусков) и дополнительные копии в том же формате
+        targets = [self.target_dir]
+        for mirror in self.mirror_dirs:
+            if mirror and mirror not in targets:
+                targets.append(mirror)
+        return targets
+
+    def _log_target_stats(self, targets, sinks):
+        stats = {}
+        for target, sink in zip(targets, sinks):
+            rate = sink.bytes_written / sink.busy_time if sink.busy_time > 0 else 0
+            stats[target] = {"ok": sink.error is None, "bytes": sink.bytes_written,
+                             "seconds": round(sink.busy_time, 3)}
+            if sink.error is not None:
+                stats[target]["error"] = str(sink.error)
+                self._log(f"Цель {target}: архив не сохранён: {sink.error}", logging.ERROR)
+            elif len(sinks) > 1:
+                self._log(f"Цель {target}: записано {sink.bytes_written / 1024 / 1024:.1f} МБ "
+                          f"за {sink.busy_time:.1f} с ({rate / 1024 / 1024:.1f} МБ/с)")
+        return stats
+
+    def _scan_sources(self, progress):
+        # Один проход os.scandir: stat из DirEntry переиспользуется архиватором
+        for source_dir in self.source_dirs:
+            source_dir_name = os.path.basename(os.path.normpath(source_dir))
+            try:
+                rules = ExcludeRules.for_source(self.exclude_patterns, source_dir)
+            except Exception as e:
+                self._log(f"Ошибка в правилах исключения для {source_dir}: {e}")
+                continue
+            yield from self._scan_tree(source_dir, "", source_dir_name, rules, progress)
+
+        file_rules = ExcludeRules(self.exclude_patterns)
+        for filepath in self.source_files:
+            if not os.path.isfile(filepath):
+                self._log(f"Файл не найден и пропущен: {filepath}")
+                continue
+            filename = os.path.basename(filepath)
+            if file_rules.is_excluded(filename):
+                self._log(f"Файл исключён по маске: {filepath}")
+                continue
+            try:
+                st = os.stat(filepath)
+            except OSError as e:
+                self._log(f"Ошибка при чтении атрибутов {filepath}: {e}")
+                progress.error()
+                continue
+            progress.found(st.st_size)
+            yield filepath, "files/" + filename, st
+
+    def _scan_tree(self, folder, rel_folder, source_dir_name, rules, progress):
+        # Исключённый каталог отсекается целиком, его содержимое не читается
+        stack = [(folder, rel_folder)]
+        while stack:
+            folder, rel_folder = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError as e:
+                self._log(f"Ошибка чтения каталога {folder}: {e}")
+                progress.error()
+                continue
+            subfolders = []
+            for entry in entries:
+                rel_path = rel_folder + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not (rules and rules.is_excluded(rel_path, True)):
+                            subfolders.append((entry.path, rel_path + "/"))
+                    elif entry.is_file() and not (rules and rules.is_excluded(rel_path)):
+                        st = entry.stat()
+                        progress.found(st.st_size)
+                        yield entry.path, source_dir_name + "/" + rel_path, st
+                except OSError as e:
+                    self._log(f"Ошибка при чтении атрибутов {entry.path}: {e}")
+                    progress.error()
+            stack.extend(reversed(subfolders))
+
+    def _iter_backup_files(self, progress, throttle):
+        # Обход идёт в отдельном потоке, чтобы чтение метаданных шло параллельно со сжатием
+        found = Queue(maxsize=SCAN_QUEUE_SIZE)
+        abort = threading.Event()
+
+        def produce():
+            throttle.lower_thread_priority()
+            started = time.monotonic()
+            blocked = 0.0
+            try:
+                for item in self._scan_sources(progress):
+                    wait_started = time.monotonic()
+                    while not abort.is_set():
+                        try:
+                            found.put(item, timeout=0.5)
+                            break
+                        except Full:
+                            pass
+                    blocked += time.monotonic() - wait_started
+                    if abort.is_set():
+                        return
+            except Exception as e:
+                self._log(f"Ошибка при обходе источников: {e}")
+            finally:
+                progress.scan_finished(time.monotonic() - started - blocked)
+                found.put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = found.get()
+                if item is None:
+                    return
+                yield item
+        finally:
+            abort.set()
+            # Освобождаем место в очереди, чтобы сканер мог завершиться
+            while producer.is_alive():
+                try:
+                    found.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    def _new_progress(self, use_last_run=True):
+        last_run = {}
+        path = os.path.join(self.target_dir, STATE_DIR_NAME, LAST_RUN_FILE)
+        if use_last_run and os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    last_run = json.load(f)
+            except Exception as e:
+                self._log(f"Ошибка при чтении итогов прошлого запуска: {e}")
+        self.current_progress = BackupProgress(last_run.get("files", 0), last_run.get("bytes", 0))
+        return self.current_progress
+
+    def _save_last_run(self, progress, codec_stats=None, consistency=None, targets=None, phases=None):
+        try:
+            state_dir = os.path.join(self.target_dir, STATE_DIR_NAME)
+            os.makedirs(state_dir, exist_ok=True)
+            _write_json_atomic(os.path.join(state_dir, LAST_RUN_FILE),
+                               {"files": progress.files_found, "bytes": progress.bytes_found,
+                                "codecs": codec_stats or {}, "consistency": consistency or {},
+                                "targets": targets or {}, "phases": phases or {}})
+        except Exception as e:
+            self._log(f"Ошибка при сохранении итогов запуска: {e}")
+
+    def _log_consistency_stats(self, writer):
+        if writer.retried or writer.staged:
+            self._log(f"Согласованность: перечитано файлов {writer.retried}, через промежуточную копию "
+                      f"{writer.staged}, несогласованных копий {len(writer.inconsistent)}")
+
+    def _log_throttle_stats(self, throttle):
+        limiter = throttle.limiter
+        elapsed = time.monotonic() - limiter.started
+        limit = f"{limiter.rate / 1024 / 1024:.1f} МБ/с" if limiter.rate > 0 else "нет"
+        if throttle.shared_limiter and throttle.shared_limiter.rate > 0:
+            limit += f", общий на все задания: {throttle.shared_limiter.rate / 1024 / 1024:.1f} МБ/с"
+        self._log(f"Прочитано {limiter.bytes_total / 1024 / 1024:.1f} МБ за {elapsed:.1f} с "
+                  f"({limiter.achieved_rate() / 1024 / 1024:.1f} МБ/с, лимит: {limit})")
+
+    def _log_codec_stats(self, codec_stats):
+        for codec, stat in sorted(codec_stats.items()):
+            ratio = stat["bytes_out"] / stat["bytes_in"] * 100 if stat["bytes_in"] else 100
+            self._log(f"Кодек {codec}: файлов {stat['files']}, "
+                      f"на входе {stat['bytes_in'] / 1024 / 1024:.1f} МБ, "
+                      f"на выходе {stat['bytes_out'] / 1024 / 1024:.1f} МБ ({ratio:.0f}%), "
+                      f"CPU {stat['cpu_time']:.1f} с")
+
+    # --- Предварительная оценка запуска ---
+    def estimate_run(self):
+        """Оценка размера и длительности следующего запуска до начала работы.
+
+        Атрибуты читаются только у выборки файлов (_sample_sources), каждый файл
+        выборки представляет все файлы своего каталога. Из выборки отбираются файлы,
+        которые запуск будет читать, и к ним применяются степени сжатия по
+        расширениям из прошлых запусков. Размер и время возвращаются тройками
+        (нижняя граница, ожидаемое, верхняя граница); время - None без истории.
+        """
+        unchanged = self._unchanged_predicate()
+        deadline = time.monotonic() + PREFLIGHT_MAX_SECONDS
+        by_ext = {}
+        truncated = False
+        seen = 0
+        total = 0.0
+        for filepath, arcname, st, weight in self._sample_sources():
+            if time.monotonic() > deadline:
+                truncated = True
+                break
+            seen += 1
+            total += weight
+            if unchanged(arcname, st):
+                continue
+            ext = by_ext.setdefault(os.path.splitext(arcname)[1].lower(), {"files": 0, "bytes": 0, "samples": []})
+            ext["files"] += weight
+            ext["bytes"] += st.st_size * weight
+            if len(ext["samples"]) < PREFLIGHT_SAMPLE_FILES and st.st_size > 0:
+                ext["samples"].append(filepath)
+
+        # Недообойдённое дерево достраивается по числу файлов прошлого запуска, а границы расширяются
+        last_run = self._load_state_json(LAST_RUN_FILE)
+        scale = 1.0
+        if truncated and total:
+            scale = max(1.0, last_run.get("files", 0) / total)
+        # Выборка расширяет границы: изменённые файлы каталога могли в неё не попасть
+        spread = 0.25 if truncated or seen < total else 0.0
+
+        ratios = self._load_state_json(RATIOS_FILE)
+        files = sum(ext["files"] for ext in by_ext.values())
+        data = sum(ext["bytes"] for ext in by_ext.values())
+        size = [0.0, 0.0, 0.0]
+        for name, ext in by_ext.items():
+            low, mid, high = self._ratio_band(name, ext["samples"], ratios)
+            size[0] += ext["bytes"] * low
+            size[1] += ext["bytes"] * mid
+            size[2] += ext["bytes"] * high
+        overhead = files * ZIP_ENTRY_OVERHEAD if self.backup_mode in ("full", "incremental") else 0
+        size = [(value + overhead) * scale for value in size]
+        size = (size[0] * (1 - spread), size[1], size[2] * (1 + spread))
+
+        # Скорость - по успешным запускам из истории: разброс скоростей и даёт границы времени
+        rates = sorted(run["bytes_read"] / run["duration"] for run in self._recent_runs()
+                       if run.get("ok") and run.get("duration", 0) >= 1 and run.get("bytes_read", 0) >= 1024 * 1024)
+        duration = None
+        if rates:
+            to_read = data * scale
+            duration = (to_read / rates[-1] * (1 - spread), to_read / rates[len(rates) // 2],
+                        to_read / rates[0] * (1 + spread))
+
+        free = {}
+        for target in self._target_dirs():
+            try:
+                free[target] = shutil.disk_usage(target).free
+                if self.backup_mode in ("full", "incremental") and self._retention_enabled():
+                    free[target] += self._plan_retention(target)[1]
+            except OSError:
+                continue
+        return {"files": round(files * scale), "bytes": round(data * scale), "files_seen": seen,
+                "sampled": seen < total, "truncated": truncated, "size": tuple(round(value) for value in size),
+                "duration": duration, "free": free}
+
+    def _sample_sources(self):
+        # Как _scan_sources, но stat - только у PREFLIGHT_DIR_SAMPLE файлов каталога, взятых равномерно
+        # по списку; вес файла - сколько файлов каталога он представляет. Каталоги берутся в случайном
+        # порядке, чтобы прерванный по времени обход был выборкой из всего дерева, а не его началом
+        rng = random.Random()
+        stack = []
+        for source_dir in self.source_dirs:
+            try:
+                rules = ExcludeRules.for_source(self.exclude_patterns, source_dir)
+            except Exception:
+                continue
+            stack.append((source_dir, "", os.path.basename(os.path.normpath(source_dir)), rules))
+        file_rules = ExcludeRules(self.exclude_patterns)
+        for filepath in self.source_files:
+            try:
+                if not file_rules.is_excluded(os.path.basename(filepath)):
+                    yield filepath, "files/" + os.path.basename(filepath), os.stat(filepath), 1
+            except OSError:
+                continue
+        while stack:
+            index = rng.randrange(len(stack))
+            stack[index], stack[-1] = stack[-1], stack[index]
+            folder, rel_folder, source_dir_name, rules = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                continue
+            files = []
+            for entry in entries:
+                rel_path = rel_folder + entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not (rules and rules.is_excluded(rel_path, True)):
+                            stack.append((entry.path, rel_path + "/", source_dir_name, rules))
+                    elif entry.is_file() and not (rules and rules.is_excluded(rel_path)):
+                        files.append((entry, rel_path))
+                except OSError:
+                    continue
+            count = min(len(files), PREFLIGHT_DIR_SAMPLE)
+            for i in range(count):
+                entry, rel_path = files[i * len(files) // count]
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, source_dir_name + "/" + rel_path, st, len(files) / count
+
+    def _unchanged_predicate(self):
+        # Какие файлы следующий запуск не будет читать: сравнение с тем, с чем сравнивает сам запуск
+        if self.backup_mode == "repository":
+            # Оценка только читает хранилище и не должна создавать его каталоги в цели
+            store = ChunkStore(os.path.join(self.target_dir, REPOSITORY_DIR_NAME), self.compression_level,
+                               create=False)
+            snapshots = store.list_snapshots() if os.path.isdir(store.snapshots_dir) else []
+            previous = store.load_snapshot(snapshots[-1])["files"] if snapshots else {}
+            return lambda arcname, st: (arcname in previous and previous[arcname]["size"] == st.st_size
+                                        and previous[arcname]["mtime_ns"] == st.st_mtime_ns)
+        if self.backup_mode == "snapshot":
+            root = os.path.join(self.target_dir, LINK_SNAPSHOTS_DIR_NAME)
+            snapshots = LinkSnapshotStore(root).list_snapshots() if os.path.isdir(root) else []
+            if not snapshots:
+                return lambda arcname, st: False
+            previous = os.path.join(root, snapshots[-1])
+
+            def unchanged(arcname, st):
+                try:
+                    return _same_content(os.lstat(os.path.join(previous, *arcname.split("/"))), st)
+                except OSError:
+                    return False
+            return unchanged
+        manifest = self._load_manifest()
+        old_files = manifest["files"] if self._next_run_incremental(manifest) else {}
+        return lambda arcname, st: (arcname in old_files
+                                    and old_files[arcname][:3] == [st.st_size, st.st_mtime_ns, st.st_ino])
+
+    def _ratio_band(self, ext, samples, ratios):
+        # Доля сжатого объёма (нижняя, ожидаемая, верхняя) для расширения
+        if self.backup_mode == "snapshot" or self.compression_level <= 0 or CodecPolicy(
+                self.compression_level, self.codec_rules).rules.get(ext) == "store":
+            return 1.0, 1.0, 1.0
+        learned = ratios.get(ext)
+        if learned and learned["bytes_in"] > 0:
+            ratio = learned["bytes_out"] / learned["bytes_in"]
+            return min(ratio, learned["min"]) * 0.95, ratio, min(1.0, max(ratio, learned["max"]) * 1.05)
+        # Истории нет - сжимаем начало нескольких файлов
+        bytes_in = bytes_out = 0
+        for path in samples:
+            try:
+                with open(path, "rb") as f:
+                    block = f.read(PREFLIGHT_SAMPLE_BYTES)
+            except OSError:
+                continue
+            bytes_in += len(block)
+            bytes_out += len(zlib.compress(block, self.compression_level))
+        if not bytes_in:
+            return 0.1, 0.5, 1.0
+        ratio = min(1.0, bytes_out / bytes_in)
+        return ratio * 0.7, ratio, min(1.0, ratio * 1.3 + 0.05)
+
+    def _update_ratios(self, extensions):
+        # Старая история весит половину, поэтому оценка следует за изменениями данных
+        if not extensions:
+            return
+        ratios = self._load_state_json(RATIOS_FILE)
+        for ext, (bytes_in, bytes_out) in extensions.items():
+            if bytes_in < 4096:
+                continue  # на мелких файлах степень сжатия случайна
+            ratio = bytes_out / bytes_in
+            old = ratios.get(ext)
+            if old:
+                ratios[ext] = {"bytes_in": old["bytes_in"] / 2 + bytes_in,
+                               "bytes_out": old["bytes_out"] / 2 + bytes_out,
+                               "min": min(old["min"], ratio), "max": max(old["max"], ratio)}
+            else:
+                ratios[ext] = {"bytes_in": bytes_in, "bytes_out": bytes_out, "min": ratio, "max": ratio}
+        try:
+            os.makedirs(os.path.join(self.target_dir, STATE_DIR_NAME), exist_ok=True)
+            _write_json_atomic(os.path.join(self.target_dir, STATE_DIR_NAME, RATIOS_FILE), ratios)
+        except Exception as e:
+            self._log(f"Ошибка при сохранении степеней сжатия: {e}")
+
+    def _load_state_json(self, name):
+        path = os.path.join(self.target_dir, STATE_DIR_NAME, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _recent_runs(self, limit=20):
+        path = os.path.join(self.target_dir, STATE_DIR_NAME, RUNS_HISTORY_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = deque(f, maxlen=limit)
+        except OSError:
+            return []
+        runs = []
+        for line in lines:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                continue
+        return runs
+
+    def log_estimate(self, estimate):
+        mb = 1024 * 1024
+        low, mid, high = estimate["size"]
+        message = (f"Оценка запуска: к записи файлов {estimate['files']} ({estimate['bytes'] / mb:.1f} МБ), "
+                   f"размер копии около {mid / mb:.1f} МБ ({low / mb:.1f}-{high / mb:.1f} МБ)")
+        if estimate["duration"]:
+            low, mid, high = estimate["duration"]
+            message += f", время около {_format_duration(mid)} ({_format_duration(low)}-{_format_duration(high)})"
+        if estimate["truncated"]:
+            message += f"; обход прерван на {estimate['files_seen']} файлах выборки, остальное - по прошлому запуску"
+        elif estimate["sampled"]:
+            message += f"; по выборке из {estimate['files_seen']} файлов"
+        self._log(message)
+
+    def _preflight_check(self):
+        # False - запуск не начинается: копия не поместится в цель, а политика требует отказа
+        if self.preflight_policy not in ("warn", "refuse"):
+            return True
+        try:
+            estimate = self.estimate_run()
+        except Exception as e:
+            self._log(f"Ошибка при предварительной оценке запуска: {e}")
+            return True
+        self.log_estimate(estimate)
+        mb = 1024 * 1024
+        _low, mid, high = estimate["size"]
+        for target, free in estimate["free"].items():
+            if mid > free:
+                message = (f"Копия не поместится в {target}: нужно около {mid / mb:.1f} МБ, "
+                           f"доступно {free / mb:.1f} МБ")
+                if self.preflight_policy == "refuse":
+                    self._log(f"Запуск отменён. {message}", logging.ERROR)
+                    self._show_notification(f"Запуск отменён. {message}")
+                    return False
+                self._log(message, logging.WARNING)
+                self._show_notification(message)
+            elif high > free:
+                self._log(f"Копия может не поместиться в {target}: верхняя оценка {high / mb:.1f} МБ, "
+                          f"доступно {free / mb:.1f} МБ", logging.WARNING)
+        return True
+
+    # --- Метрики запусков ---
+    def _export_metrics(self, progress, throttle, ok, extra):
+        # Итоги запуска: строка в истории runs.jsonl и снимок для textfile-коллектора node_exporter
+        metrics = {
+            "job": self.name,
+            "mode": self.backup_mode,
+            "ok": ok,
+            "finished": round(time.time(), 3),
+            "duration": round(progress.finished - progress.started, 3),
+            "files_found": progress.files_found,
+            "files_done": progress.files_done,
+            "errors": progress.errors,
+            "bytes_found": progress.bytes_found,
+            "bytes_read": throttle.limiter.bytes_total,
+        }
+        metrics.update(extra)
+        try:
+            state_dir = os.path.join(self.target_dir, STATE_DIR_NAME)
+            os.makedirs(state_dir, exist_ok=True)
+            path = os.path.join(state_dir, RUNS_HISTORY_FILE)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(metrics, ensure_ascii=False) + "\n")
+            if os.path.getsize(path) > RUNS_HISTORY_MAX_BYTES:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.writelines(lines[len(lines) // 2:])
+                os.replace(path + ".tmp", path)
+        except Exception as e:
+            self._log(f"Ошибка при сохранении итогов запуска в историю: {e}")
+        if not self.metrics_dir:
+            return
+        try:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            # Имя файла только из латиницы; если имя задания пришлось изменить, к нему добавляется
+            # хеш исходного, иначе задания "дом" и "баз" писали бы в один файл. Само имя - в метке job
+            name = re.sub(r"[^A-Za-z0-9_]", "_", self.name)
+            if name != self.name:
+                name += "_" + hashlib.sha1(self.name.encode("utf-8")).hexdigest()[:8]
+            name = "backup_" + name + ".prom"
+            path = os.path.join(self.metrics_dir, name)
+            # Коллектор читает только *.prom, поэтому файл не будет прочитан наполовину записанным
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(_prometheus_text(metrics))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            self._log(f"Ошибка при записи метрик в {self.metrics_dir}: {e}")
+
+    # --- Репозиторий с дедупликацией блоков ---
+    def _create_repository_snapshot(self, throttle):
+        if len(self._target_dirs()) > 1:
+            self._log("Репозиторий ведётся только в основной цели, дополнительные цели не используются",
+                      logging.WARNING)
+        progress = self._new_progress()
+        metrics = {"type": "repository"}
+        run_ok = False
+        try:
+            store = ChunkStore(os.path.join(self.target_dir, REPOSITORY_DIR_NAME), self.compression_level)
+            snapshots = store.list_snapshots()
+            previous = store.load_snapshot(snapshots[-1])["files"] if snapshots else {}
+            files = {}
+
+            for filepath, arcname, st in self._iter_backup_files(progress, throttle):
+                try:
+                    old_entry = previous.get(arcname)
+                    # Неизменённый файл не читаем: берём список блоков из прошлого снимка
+                    if old_entry and old_entry["size"] == st.st_size and old_entry["mtime_ns"] == st.st_mtime_ns:
+                        files[arcname] = old_entry
+                    else:
+                        files[arcname] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                          "chunks": store.store_file(filepath, throttle)}
+                        self._log(f"Добавлен в репозиторий: {filepath}", logging.DEBUG)
+                except Exception as e:
+                    self._log(f"Ошибка при добавлении файла {filepath}: {e}")
+                    progress.error()
+                progress.done(st.st_size)
+
+            name = store.save_snapshot({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "files": files})
+            self._save_last_run(progress)
+            self._log(f"Снимок создан: {name} (файлов: {len(files)}, новых блоков: {store.chunks_new}, "
+                      f"новых данных: {store.bytes_new / 1024 / 1024:.1f} МБ, "
+                      f"повторно использовано: {store.bytes_reused / 1024 / 1024:.1f} МБ)")
+            self._show_notification(f"Снимок создан: {name} (файлов: {len(files)})")
+            metrics.update(files_archived=len(files), bytes_written={self.target_dir: store.bytes_new})
+            run_ok = True
+        except Exception as e:
+            self._log(f"Ошибка при создании снимка: {e}")
+            self._show_notification(f"Ошибка при создании снимка: {e}")
+        finally:
+            progress.finish()
+            self._export_metrics(progress, throttle, run_ok, metrics)
+
+    # --- Снимки с жёсткими ссылками ---
+    def _create_link_snapshot(self, throttle):
+        if len(self._target_dirs()) > 1:
+            self._log("Снимки ведутся только в основной цели, дополнительные цели не используются",
+                      logging.WARNING)
+        progress = self._new_progress()
+        metrics = {"type": "snapshot"}
+        run_ok = False
+        try:
+            store = LinkSnapshotStore(os.path.join(self.target_dir, LINK_SNAPSHOTS_DIR_NAME), self.snapshot_reflink)
+            snapshots = store.list_snapshots()
+            previous = os.path.join(store.root, snapshots[-1]) if snapshots else None
+            partial, resumed = store.begin()
+            if resumed:
+                self._log(f"Продолжение прерванного снимка: {os.path.basename(partial)}")
+            arcnames = set()
+
+            for filepath, arcname, st in self._iter_backup_files(progress, throttle):
+                if self.stop_event.is_set():
+                    self._log(f"Запуск прерван, следующий запуск продолжит снимок {os.path.basename(partial)}")
+                    metrics = None
+                    return
+                try:
+                    if not store.add_file(filepath, arcname, st, partial, previous, throttle,
+                                          self.consistency_retries):
+                        self._log(f"Файл изменялся во время чтения, в снимке несогласованная копия: {filepath}",
+                                  logging.WARNING)
+                    arcnames.add(arcname)
+                    self._log(f"Добавлен в снимок: {filepath}", logging.DEBUG)
+                except Exception as e:
+                    self._log(f"Ошибка при добавлении файла {filepath}: {e}")
+                    progress.error()
+                    # Временная ошибка чтения не должна убрать файл из снимка: остаётся прошлая версия
+                    dest = os.path.join(partial, *arcname.split("/"))
+                    try:
+                        if previous and not os.path.lexists(dest) and store.reuse_previous(arcname, dest, previous):
+                            arcnames.add(arcname)
+                    except OSError as link_error:
+                        self._log(f"Прошлая версия {arcname} не перенесена: {link_error}")
+                progress.done(st.st_size)
+
+            if resumed:
+                store.prune(partial, arcnames)
+            name = store.commit(partial)
+            self._save_last_run(progress)
+            self._log(f"Снимок создан: {name} (файлов: {len(arcnames)}, ссылок: {store.linked}, "
+                      f"клонов: {store.cloned}, скопировано: {store.copied} - "
+                      f"{store.bytes_copied / 1024 / 1024:.1f} МБ, "
+                      f"без копирования: {store.bytes_reused / 1024 / 1024:.1f} МБ)")
+            self._show_notification(f"Снимок создан: {name} (файлов: {len(arcnames)})")
+            metrics.update(files_archived=store.copied, files_skipped=store.linked + store.cloned,
+                           bytes_written={self.target_dir: store.bytes_copied})
+            run_ok = True
+        except Exception as e:
+            self._log(f"Ошибка при создании снимка: {e}")
+            self._show_notification(f"Ошибка при создании снимка: {e}")
+        finally:
+            progress.finish()
+            if metrics is not None:
+                self._export_metrics(progress, throttle, run_ok, metrics)
+
+    def _backup_file(self, writer, filepath, arcname, st, old_files, new_files, throttle):
+        # Неизменённый файл сразу переносится в новый манифест, изменённый - ставится в очередь на сжатие
+        old_entry = old_files.get(arcname)
+        try:
+            entry = [st.st_size, st.st_mtime_ns, st.st_ino, None]
+            if old_entry is not None:
+                if old_entry[:3] == entry[:3]:
+                    new_files[arcname] = old_entry
+                    return
+                # Метаданные изменились, но содержимое могло остаться прежним
+                if self.hash_files and old_entry[3] and old_entry[0] == st.st_size:
+                    entry[3] = _file_digest(filepath, throttle=throttle)
+                    if entry[3] == old_entry[3]:
+                        new_files[arcname] = entry
+                        return
+            if self.hash_files and entry[3] is None:
+                entry[3] = _file_digest(filepath, throttle=throttle)
+            delta = self._delta_job(arcname, st, old_entry)
+        except Exception as e:
+            self._on_file_archived(e, filepath, arcname, None, old_entry, new_files)
+            return
+        writer.submit(filepath, arcname,
+                      lambda error, consistent: self._on_file_archived(error, filepath, arcname, entry, old_entry,
+                                                                       new_files, consistent, delta),
+                      delta, st, entry[3])
+
+    def _on_file_archived(self, error, filepath, arcname, entry, old_entry, new_files, consistent=True, delta=None):
+        if error is None:
+            if not consistent:
+                # Время изменения не запоминаем, чтобы следующий инкрементальный запуск перечитал файл
+                entry = [entry[0], None, entry[2], None]
+                self._log(f"Файл изменялся во время чтения, в архиве несогласованная копия: {filepath}",
+                          logging.WARNING)
+            new_files[arcname] = entry
+            if delta is not None:
+                self._save_signature(arcname, entry, delta)
+            self._log(f"Добавлен в архив: {filepath}", logging.DEBUG)
+            return
+        self._log(f"Ошибка при добавлении файла {filepath}: {error}")
+        self.current_progress.error()
+        # Файл не должен попасть в надгробия из-за временной ошибки чтения
+        if old_entry is not None:
+            new_files[arcname] = old_entry
+
+    # --- Дельты больших файлов ---
+    def _delta_job(self, arcname, st, old_entry):
+        # Дельта строится к версии из манифеста, только если подписи описывают именно её.
+        # Подписи нужны только инкрементальным запускам и сбросам изменений: в режиме полных
+        # копий без отслеживания их никто не прочтёт
+        if not self.delta_min_size_mb or st.st_size < self.delta_min_size_mb * 1024 * 1024:
+            return None
+        if self.backup_mode != "incremental" and not self.watch_changes:
+            return None
+        block_size = self.delta_block_kb * 1024
+        signature = self._load_signature(arcname) if old_entry is not None and old_entry[1] is not None else None
+        if (signature and signature["block_size"] == block_size and signature["chain"] < self.delta_max_chain
+                and [signature["size"], signature["mtime_ns"]] == old_entry[:2]):
+            return _DeltaJob(block_size, signature["blocks"], signature["chain"] + 1)
+        return _DeltaJob(block_size)
+
+    def _signature_path(self, arcname):
+        name = hashlib.sha1(arcname.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.target_dir, STATE_DIR_NAME, SIGNATURES_DIR_NAME, name)
+
+    def _load_signature(self, arcname):
+        try:
+            with open(self._signature_path(arcname), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_signature(self, arcname, entry, delta):
+        path = self._signature_path(arcname)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_json_atomic(path, {"arcname": arcname, "size": delta.size, "mtime_ns": entry[1],
+                                      "block_size": delta.block_size,
+                                      "chain": delta.chain if delta.changed is not None else 0,
+                                      "blocks": delta.new_blocks})
+        except Exception as e:
+            self._log(f"Ошибка при сохранении подписей блоков {arcname}: {e}")
+
+    # --- Политика хранения ---
+    def _retention_enabled(self):
+        return self.retention_daily > 0 or self.retention_weekly > 0 or self.retention_monthly > 0
+
+    def _plan_retention(self, target_dir=None):
+        # Возвращает (список архивов к удалению, освобождаемые байты)
+        archives = _list_archives(target_dir or self.target_dir)
+        stamps = [datetime.strptime("".join(a.split(os.sep)[-2:])[:-4], "%Y%m%d%H%M%S") for a in archives]
+        keep = _gfs_keep(stamps, self.retention_daily, self.retention_weekly, self.retention_monthly)
+
+        # Инкрементальной копии нужна вся цепочка до ближайшей полной
+        types = []
+        for path in archives:
+            try:
+                with ZipFile(path) as zipf:
+                    types.append(_read_archive_meta(zipf).get("type", "full"))
+            except Exception as e:
+                self._log(f"Архив {path} не прочитан, он будет сохранён: {e}")
+                types.append(None)
+        for i in sorted(keep, reverse=True):
+            j = i
+            while j > 0 and types[j] != "full":
+                j -= 1
+                keep.add(j)
+        keep.update(i for i, kind in enumerate(types) if kind is None)
+
+        remove = [a for i, a in enumerate(archives) if i not in keep]
+        return remove, sum(os.path.getsize(a) for a in remove)
+
+    def _apply_retention(self):
+        if not self._retention_enabled():
+            return
+        if self.backup_mode in ("repository", "snapshot"):
+            try:
+                if self.backup_mode == "repository":
+                    self._apply_repository_retention()
+                else:
+                    self._apply_link_snapshot_retention()
+            except Exception as e:
+                self._log(f"Ошибка при применении политики хранения: {e}")
+            return
+        # Цели хранят копии независимо: недоступная цель не мешает чистке остальных
+        for target_dir in self._target_dirs():
+            try:
+                remove, freed = self._plan_retention(target_dir)
+                if not remove:
+                    continue
+                catalog = BackupCatalog(target_dir)
+                for path in remove:
+                    os.remove(path)
+                    catalog.remove_archive(path)
+                    folder = os.path.dirname(path)
+                    if not os.listdir(folder):
+                        os.rmdir(folder)
+                    self._log(f"Удалён устаревший архив: {path}")
+                self._log(f"Политика хранения: удалено архивов {len(remove)}, освобождено {freed / 1024 / 1024:.1f} МБ")
+            except Exception as e:
+                self._log(f"Ошибка при применении политики хранения в {target_dir}: {e}")
+
+    def _apply_repository_retention(self):
+        store = ChunkStore(os.path.join(self.target_dir, REPOSITORY_DIR_NAME), self.compression_level)
+        names = store.list_snapshots()
+        stamps = [datetime.strptime(name[:-5], "%Y%m%d-%H%M%S") for name in names]
+        keep = _gfs_keep(stamps, self.retention_daily, self.retention_weekly, self.retention_monthly)
+        remove = [name for i, name in enumerate(names) if i not in keep]
+        if not remove:
+            return
+        for name in remove:
+            store.delete_snapshot(name)
+            self._log(f"Удалён устаревший снимок: {name}")
+        removed, freed = store.collect_garbage()
+        self._log(f"Политика хранения: удалено снимков {len(remove)}, блоков {removed}, "
+                  f"освобождено {freed / 1024 / 1024:.1f} МБ")
+
+    def _apply_link_snapshot_retention(self):
+        # Снимки независимы: удаление каталога освобождает только блоки, на которые больше нет ссылок
+        store = LinkSnapshotStore(os.path.join(self.target_dir, LINK_SNAPSHOTS_DIR_NAME))
+        names = store.list_snapshots()
+        stamps = [datetime.strptime(name, "%Y%m%d-%H%M%S") for name in names]
+        keep = _gfs_keep(stamps, self.retention_daily, self.retention_weekly, self.retention_monthly)
+        remove = [name for i, name in enumerate(names) if i not in keep]
+        for name in remove:
+            store.delete_snapshot(name)
+            self._log(f"Удалён устаревший снимок: {name}")
+        if remove:
+            self._log(f"Политика хранения: удалено снимков {len(remove)}")
+
+    # --- Манифест задания ---
+    def _manifest_path(self):
+        return os.path.join(self.target_dir, STATE_DIR_NAME, MANIFEST_FILE)
+
+    def _load_manifest(self):
+        manifest = {"incrementals_since_full": 0, "files": {}}
+        path = self._manifest_path()
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    manifest.update(json.load(f))
+            except Exception as e:
+                self._log(f"Ошибка при загрузке манифеста, будет создана полная копия: {e}")
+                manifest = {"incrementals_since_full": 0, "files": {}}
+        return manifest
+
+    def _save_manifest(self, manifest):
+        try:
+            os.makedirs(os.path.dirname(self._manifest_path()), exist_ok=True)
+            _write_json_atomic(self._manifest_path(), manifest)
+        except Exception as e:
+            self._log(f"Ошибка при сохранении манифеста: {e}")
+
+    # --- Восстановление ---
+    def _restore_single_file(self, target_dir, query, dest_dir):
+        # True - файл восстановлен; консольный режим возвращает по нему код завершения
+        try:
+            catalog = BackupCatalog(target_dir)
+            for version in catalog.find_versions(query):
+                mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version["mtime"]))
+                self._log(f"Версия {version['arcname']} от {mtime}: {version['archive']}")
+            restored = catalog.restore_latest(query, dest_dir)
+            if restored is None:
+                self._log(f"Файл не найден в каталоге: {query}")
+                return False
+            version, dest_path = restored
+            self._log(f"Восстановлен {dest_path} из {version['archive']}")
+            self._show_notification(f"Файл восстановлен: {dest_path}")
+            return True
+        except Exception as e:
+            self._log(f"Ошибка при восстановлении файла: {e}")
+            self._show_notification(f"Ошибка при восстановлении файла: {e}")
+            return False
+
+    def _snapshot_store(self, snapshot_path):
+        # snapshots/<имя>.json лежит внутри корня репозитория
+        root = os.path.dirname(os.path.dirname(os.path.abspath(snapshot_path)))
+        return ChunkStore(root, self.compression_level), os.path.basename(snapshot_path)
+
+    def _restore_snapshot(self, snapshot_path, dest_dir):
+        try:
+            store, name = self._snapshot_store(snapshot_path)
+            count = store.restore_snapshot(name, dest_dir)
+            self._log(f"Восстановление снимка {name} завершено в {dest_dir} (файлов: {count})")
+            self._show_notification(f"Восстановление завершено: {dest_dir}")
+        except Exception as e:
+            self._log(f"Ошибка при восстановлении снимка: {e}")
+            self._show_notification(f"Ошибка при восстановлении снимка: {e}")
+
+    def _restore_link_snapshot(self, snapshot_dir, dest_dir):
+        # Снимок - обычное дерево файлов, восстановление сводится к копированию
+        try:
+            shutil.copytree(snapshot_dir, dest_dir, symlinks=True, dirs_exist_ok=True)
+            self._log(f"Восстановление снимка {os.path.basename(os.path.normpath(snapshot_dir))} "
+                      f"завершено в {dest_dir}")
+            self._show_notification(f"Восстановление завершено: {dest_dir}")
+        except Exception as e:
+            self._log(f"Ошибка при восстановлении снимка: {e}")
+            self._show_notification(f"Ошибка при восстановлении снимка: {e}")
+
+    def _export_snapshot(self, snapshot_path, zip_path):
+        try:
+            store, name = self._snapshot_store(snapshot_path)
+            count = store.export_zip(name, zip_path, self.compression_level)
+            self._log(f"Снимок {name} выгружен в {zip_path} (файлов: {count})")
+        except Exception as e:
+            self._log(f"Ошибка при экспорте снимка: {e}")
+
+    def _restore_chain(self, archive_path, dest_dir):
+        # Полная копия + все инкрементальные копии после неё вплоть до выбранной
+        try:
+            target_dir = os.path.dirname(os.path.dirname(os.path.abspath(archive_path)))
+            archives = [a for a in _list_archives(target_dir) if a <= os.path.abspath(archive_path)]
+            chain = []
+            for path in reversed(archives):
+                with ZipFile(path) as zipf:
+                    meta = _read_archive_meta(zipf)
+                chain.append(path)
+                if meta.get("type", "full") == "full":
+                    break
+            chain.reverse()
+
+            for path in chain:
+                with ZipFile(path) as zipf:
+                    meta = _read_archive_meta(zipf)
+                    refs = _read_archive_refs(zipf)
+                    deltas = {arcname + DELTA_SUFFIX: arcname for arcname in meta.get("deltas", [])}
+                    members = [m for m in zipf.namelist()
+                               if m not in (ARCHIVE_META_NAME, ARCHIVE_REFS_NAME) and m not in deltas]
+                    zipf.extractall(dest_dir, members)
+                    for member, arcname in deltas.items():
+                        with zipf.open(member) as delta:
+                            _apply_delta(delta, os.path.join(dest_dir, *arcname.split("/")))
+                # Повторы копируются с уже восстановленной копии того же архива
+                for arcname, original in refs.items():
+                    ref_path = os.path.join(dest_dir, *arcname.split("/"))
+                    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+                    shutil.copyfile(os.path.join(dest_dir, *original.split("/")), ref_path)
+                for arcname in meta.get("deleted", []):
+                    stale_path = os.path.join(dest_dir, *arcname.split("/"))
+                    if os.path.isfile(stale_path):
+                        os.remove(stale_path)
+                self._log(f"Применён архив: {path}")
+            self._log(f"Восстановление завершено в {dest_dir} (архивов в цепочке: {len(chain)})")
+            self._show_notification(f"Восстановление завершено: {dest_dir}")
+        except Exception as e:
+            self._log(f"Ошибка при восстановлении: {e}")
+            self._show_notification(f"Ошибка при восстановлении: {e}")
+
+
+class _JobEngine(BackupEngine):
+    """Движок одного задания планировщика: сообщения и ход работы передаются владельцу."""
+
+    def __init__(self, owner, name):
+        super().__init__()
+        self.owner = owner
+        self.name = name
+
+    def _log(self, message, level=logging.INFO):
+        # Подробность - из настроек задания, а не владельца
+        if level >= LOG_LEVELS.get(self.log_verbosity, logging.INFO):
+            self.owner._write_log(f"[{self.name}] {message}", level)
+
+    def _show_notification(self, message):
+        self.owner._show_notification(f"{self.name}: {message}")
+
+    def _new_progress(self, use_last_run=True):
+        # Окно и консоль показывают ход последнего начавшегося задания
+        progress = super()._new_progress(use_last_run)
+        self.owner.current_progress = progress
+        return progress
+
+
+class JobScheduler:
+    """Центральный планировщик заданий.
+
+    Время следующих запусков хранится в куче, поэтому один поток обслуживает
+    любое число заданий. Одновременно выполняется не больше max_concurrent_jobs
+    заданий, остальные ждут в порядке наступления срока. Перепроверка архивов
+    (scrub) планируется так же, как копирование. Следующий запуск задания
+    отсчитывается от окончания предыдущего, поэтому одно задание не
+    выполняется дважды одновременно.
+    """
+
+    def __init__(self, owner, jobs):
+        self.owner = owner
+        self.jobs = jobs
+        self.max_concurrent = max(1, owner.max_concurrent_jobs)
+        self._heap = []
+        self._order = itertools.count()
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _push(self, due, job, kind):
+        # Вызывается под self._cond
+        heapq.heappush(self._heap, (due, next(self._order), job, kind))
+        backups = [item[0] for item in self._heap if item[3] == "backup"]
+        self.owner.next_backup_time = min(backups) if backups else None
+
+    def run(self):
+        now = time.time()
+        with self._cond:
+            for job in self.jobs:
+                if job.watch_changes:
+                    job._log("Наблюдение за изменениями в режиме нескольких заданий не используется")
+                self._push(now, job, "backup")
+                if job.scrub_interval_hours > 0:
+                    self._push(now + job.scrub_interval_hours * 3600, job, "scrub")
+        self.owner._log(f"Планировщик запущен: заданий {len(self.jobs)}, одновременно до {self.max_concurrent}")
+        workers = []
+        while not self.owner.stop_event.is_set():
+            with self._cond:
+                # Ждём срока ближайшего запуска и свободного места; раз в секунду проверяем остановку
+                if not self._heap or self._running >= self.max_concurrent:
+                    self._cond.wait(1.0)
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(min(delay, 1.0))
+                    continue
+                _, _, job, kind = heapq.heappop(self._heap)
+                self._running += 1
+            worker = threading.Thread(target=self._run_job, args=(job, kind), daemon=True)
+            worker.start()
+            workers = [w for w in workers if w.is_alive()] + [worker]
+        for worker in workers:
+            worker.join()
+
+    def _run_job(self, job, kind):
+        try:
+            if kind == "scrub":
+                job.scrub_archives()
+            else:
+                job.create_backup()
+        except Exception as e:
+            job._log(f"Ошибка в процессе выполнения задания: {e}")
+        finally:
+            interval = job.scrub_interval_hours * 3600 if kind == "scrub" else job._interval_seconds()
+            with self._cond:
+                self._running -= 1
+                self._push(time.time() + interval, job, kind)
+                self._cond.notify_all()
+
+
+class BackupApp(BackupEngine):
     def __init__(self, root):
         self.root = root
         self.root.title("File backup v 1.4.7")
@@ -28,28 +3781,20 @@ class BackupApp:
         self.root.protocol("WM_DELETE_WINDOW", self._on_close_window)
         self.root.overrideredirect(True)
 
-        self.source_dirs = []
-        self.source_files = []
-        self.exclude_patterns = []
-        self.target_dir = ""
-        self.interval_hours = 24
-        self.interval_weeks = 0
-        self.compression_level = 6
-        self.backup_thread = None
-        self.stop_event = threading.Event()
+        BackupEngine.__init__(self)
         self.log_queue = Queue()
         self.running = False
 
         self._last_notifications = []
         self._notification_lock = threading.Lock()
 
-        self.next_backup_time = None
         self.status_text = tk.StringVar(value="Статус: Ожидание запуска")
 
         self._build_custom_titlebar()
         self._build_ui()
         self._load_settings()
         self._process_log_queue()
+        self._poll_progress()
 
         self._offset_x = 0
         self._offset_y = 0
@@ -187,7 +3932,7 @@ class BackupApp:
         tk.Button(self.main_frame, text="Удалить из списка", command=self.remove_source).grid(row=1, column=3, sticky="w", padx=2)
         tk.Button(self.main_frame, text="Очистить список", command=self.clear_sources).grid(row=1, column=4, sticky="w", padx=2)
 
-        tk.Label(self.main_frame, text="Каталог для резервных копий:").grid(row=2, column=0, sticky="w")
+        tk.Label(self.main_frame, text="Каталоги для резервных копий (через ;):").grid(row=2, column=0, sticky="w")
         self.target_entry = tk.Entry(self.main_frame, width=50)
         self.target_entry.grid(row=2, column=1, columnspan=3, sticky="w")
         tk.Button(self.main_frame, text="Выбрать...", command=self.select_target).grid(row=2, column=4, sticky="w", padx=2)
@@ -211,7 +3956,56 @@ class BackupApp:
         self.compression_entry.insert(0, str(self.compression_level))
         self.compression_entry.grid(row=0, column=5, padx=5)
 
-        tk.Label(self.main_frame, text="Исключить файлы по маске (через запятую *.tmp, *.log):").grid(row=4, column=0, sticky="w")
+        tk.Label(interval_frame, text="Потоков:").grid(row=0, column=6)
+        self.workers_entry = tk.Entry(interval_frame, width=3)
+        self.workers_entry.insert(0, str(self.compression_workers))
+        self.workers_entry.grid(row=0, column=7, padx=5)
+
+        tk.Label(interval_frame, text="Режим:").grid(row=0, column=8)
+        self.mode_combobox = ttk.Combobox(interval_frame, values=list(BACKUP_MODES.values()),
+                                          state="readonly", width=16)
+        self.mode_combobox.set(BACKUP_MODES[self.backup_mode])
+        self.mode_combobox.grid(row=0, column=9, padx=5)
+
+        tk.Label(interval_frame, text="Хранить дней:").grid(row=1, column=0)
+        self.retention_daily_entry = tk.Entry(interval_frame, width=5)
+        self.retention_daily_entry.insert(0, "0")
+        self.retention_daily_entry.grid(row=1, column=1, padx=5)
+
+        tk.Label(interval_frame, text="недель:").grid(row=1, column=2)
+        self.retention_weekly_entry = tk.Entry(interval_frame, width=5)
+        self.retention_weekly_entry.insert(0, "0")
+        self.retention_weekly_entry.grid(row=1, column=3, padx=5)
+
+        tk.Label(interval_frame, text="месяцев:").grid(row=1, column=4)
+        self.retention_monthly_entry = tk.Entry(interval_frame, width=3)
+        self.retention_monthly_entry.insert(0, "0")
+        self.retention_monthly_entry.grid(row=1, column=5, padx=5)
+
+        tk.Label(interval_frame, text="Чтение, МБ/с:").grid(row=1, column=6)
+        self.read_limit_entry = tk.Entry(interval_frame, width=3)
+        self.read_limit_entry.insert(0, "0")
+        self.read_limit_entry.grid(row=1, column=7, padx=5)
+
+        self.low_priority_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(interval_frame, text="Низкий приоритет",
+                       variable=self.low_priority_var).grid(row=1, column=8, columnspan=2, sticky="w")
+
+        self.watch_changes_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(interval_frame, text="Следить за изменениями (Linux)",
+                       variable=self.watch_changes_var).grid(row=2, column=0, columnspan=4, sticky="w")
+        tk.Label(interval_frame, text="Сброс, с:").grid(row=2, column=4)
+        self.watch_flush_entry = tk.Entry(interval_frame, width=5)
+        self.watch_flush_entry.insert(0, str(self.watch_flush_seconds))
+        self.watch_flush_entry.grid(row=2, column=5, padx=5)
+
+        tk.Label(interval_frame, text="Нехватка места:").grid(row=2, column=6)
+        self.preflight_combobox = ttk.Combobox(interval_frame, values=list(PREFLIGHT_POLICIES.values()),
+                                               state="readonly", width=16)
+        self.preflight_combobox.set(PREFLIGHT_POLICIES[self.preflight_policy])
+        self.preflight_combobox.grid(row=2, column=7, columnspan=3, padx=5, sticky="w")
+
+        tk.Label(self.main_frame, text="Исключить по маске (через запятую *.tmp, build/**/*.o, !keep.log):").grid(row=4, column=0, sticky="w")
         self.exclude_entry = tk.Entry(self.main_frame, width=50)
         self.exclude_entry.grid(row=4, column=1, columnspan=4, sticky="w", pady=2)
 
@@ -222,6 +4016,9 @@ class BackupApp:
         self.next_backup_label.grid(row=6, column=1, columnspan=4, sticky="w", pady=(0,10))
 
         tk.Label(self.main_frame, text="Лог резервного копирования:").grid(row=7, column=0, sticky="nw")
+        self.verbose_log_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.main_frame, text="Подробный лог (каждый файл)", variable=self.verbose_log_var,
+                       command=self._on_verbosity_changed).grid(row=8, column=0, sticky="w")
         self.log_text = scrolledtext.ScrolledText(self.main_frame, width=60, height=10, state=tk.DISABLED)
         self.log_text.grid(row=7, column=1, columnspan=4, pady=5, sticky="w")
 
@@ -229,6 +4026,9 @@ class BackupApp:
         self.progress_bar = ttk.Progressbar(self.main_frame, variable=self.progress, maximum=100)
         self.progress_bar.grid(row=8, column=1, columnspan=4, sticky="ew", pady=5)
 
+        self.progress_text = tk.StringVar(value="")
+        tk.Label(self.main_frame, textvariable=self.progress_text).grid(row=10, column=1, columnspan=2, sticky="w")
+
         self.start_button = ttk.Button(self.main_frame, text="Запустить резервное копирование", command=self.start_backup)
         self.start_button.grid(row=9, column=1, pady=10)
 
@@ -238,6 +4038,16 @@ class BackupApp:
         self.save_log_button = ttk.Button(self.main_frame, text="Сохранить лог", command=self.save_log)
         self.save_log_button.grid(row=9, column=3, pady=10)
 
+        self.restore_button = ttk.Button(self.main_frame, text="Восстановить...", command=self.restore_backup)
+        self.restore_button.grid(row=9, column=4, pady=10)
+
+        self.restore_file_button = ttk.Button(self.main_frame, text="Найти и восстановить файл...",
+                                              command=self.restore_single_file)
+        self.restore_file_button.grid(row=10, column=3, pady=(0, 10))
+
+        self.export_button = ttk.Button(self.main_frame, text="Экспорт снимка в zip...", command=self.export_snapshot)
+        self.export_button.grid(row=10, column=4, pady=(0, 10))
+
     # --- Методы управления списками ---
     def add_source(self):
         directory = filedialog.askdirectory()
@@ -295,9 +4105,11 @@ class BackupApp:
     def select_target(self):
         directory = filedialog.askdirectory()
         if directory:
+            # Выбор меняет основную цель, дополнительные цели в поле сохраняются
             self.target_dir = directory
+            mirrors = self._entry_targets()[1:]
             self.target_entry.delete(0, tk.END)
-            self.target_entry.insert(0, directory)
+            self.target_entry.insert(0, "; ".join([directory] + mirrors))
             self._log(f"Выбран каталог для резервных копий: {directory}")
 
     # --- Запуск резервного копирования ---
@@ -306,67 +4118,77 @@ class BackupApp:
             hours = int(self.hours_entry.get())
             weeks = int(self.weeks_entry.get())
             compression = int(self.compression_entry.get())
-            if hours < 0 or weeks < 0 or not (0 <= compression <= 9):
+            workers = int(self.workers_entry.get())
+            retention = (int(self.retention_daily_entry.get()), int(self.retention_weekly_entry.get()),
+                         int(self.retention_monthly_entry.get()))
+            read_limit = float(self.read_limit_entry.get())
+            watch_flush = int(self.watch_flush_entry.get())
+            if (hours < 0 or weeks < 0 or not (0 <= compression <= 9) or workers < 1 or min(retention) < 0
+                    or read_limit < 0 or watch_flush < WATCH_MIN_FLUSH_SECONDS):
                 raise ValueError
             if hours == 0 and weeks == 0:
                 messagebox.showerror("Ошибка", "Интервал копирования не может быть равен нулю")
                 return
         except ValueError:
-            messagebox.showerror("Ошибка", "Интервал и уровень сжатия должны быть целыми числами в корректном диапазоне")
+            messagebox.showerror("Ошибка", "Интервал, уровень сжатия, число потоков, сроки хранения, лимит чтения "
+                                           f"и период сброса (не меньше {WATCH_MIN_FLUSH_SECONDS} с) "
+                                           "должны быть числами в корректном диапазоне")
             return
 
         self.interval_hours = hours
         self.interval_weeks = weeks
         self.compression_level = compression
+        self.compression_workers = workers
+        self.retention_daily, self.retention_weekly, self.retention_monthly = retention
+        self.read_limit_mbps = read_limit
+        self.low_priority = self.low_priority_var.get()
+        self.watch_changes = self.watch_changes_var.get()
+        self.watch_flush_seconds = watch_flush
+        self.backup_mode = self._selected_backup_mode()
+        self.preflight_policy = self._selected_preflight_policy()
 
         exclude_text = self.exclude_entry.get().strip()
         self.exclude_patterns = [p.strip() for p in exclude_text.split(",") if p.strip()]
 
-        if not self.source_dirs and not self.source_files:
-            messagebox.showerror("Ошибка", "Не выбран ни один исходный каталог или файл")
-            return
-        for d in self.source_dirs:
-            if not os.path.isdir(d):
-                messagebox.showerror("Ошибка", f"Исходный каталог не существует:\n{d}")
-                return
-        for f in self.source_files:
-            if not os.path.isfile(f):
-                messagebox.showerror("Ошибка", f"Исходный файл не существует:\n{f}")
-                return
-
-        self.target_dir = self.target_entry.get()
-        if not os.path.isdir(self.target_dir):
-            messagebox.showerror("Ошибка", "Каталог для резервных копий не выбран или не существует")
+        targets = self._entry_targets()
+        self.target_dir = targets[0] if targets else ""
+        self.mirror_dirs = targets[1:]
+        error = self.check_paths()
+        if error:
+            messagebox.showerror("Ошибка", error)
             return
 
-        # Проверка свободного места на диске
+        # Проверка свободного места на диске с учётом того, что освободит политика хранения
         try:
             total, used, free = shutil.disk_usage(self.target_dir)
-            if free < 100 * 1024 * 1024:  # менее 100 МБ свободно
+            freed = 0
+            if self._retention_enabled() and self.backup_mode not in ("repository", "snapshot"):
+                remove, freed = self._plan_retention()
+                if remove:
+                    self._log(f"Политика хранения удалит архивов: {len(remove)} ({freed / 1024 / 1024:.1f} МБ)")
+            if free + freed < 100 * 1024 * 1024:  # менее 100 МБ свободно
                 if not messagebox.askyesno("Внимание", "Свободного места на диске мало. Продолжить?"):
                     return
         except Exception as e:
             self._log(f"Ошибка при проверке свободного места: {e}")
 
-        self.stop_event.clear()
-        self.backup_thread = threading.Thread(target=self.run_backup_schedule, daemon=True)
-        self.backup_thread.start()
+        self.start_schedule()
 
         self.start_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
         self.running = True
         self._log("Автоматическое резервное копирование запущено")
+        if self.jobs:
+            self._log(f"Задания из файла настроек: {len(self.jobs)}; параметры окна - общие значения по умолчанию")
         self._show_notification("Резервное копирование запущено")
         self.status_text.set("Статус: Резервное копирование запущено")
         messagebox.showinfo("Запуск", "Автоматическое резервное копирование запущено")
 
-        self._save_settings()
+        self.save_settings()
         self._update_next_backup_time()
 
     def stop_backup(self):
-        self.stop_event.set()
-        if self.backup_thread and self.backup_thread.is_alive():
-            self.backup_thread.join()
+        self.stop_schedule()
         self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
         self.running = False
@@ -377,23 +4199,6 @@ class BackupApp:
         self.next_backup_time = None
         self._update_next_backup_label()
 
-    # --- Основной цикл резервного копирования ---
-    def run_backup_schedule(self):
-        interval_seconds = (self.interval_weeks * 7 * 24 + self.interval_hours) * 3600
-        if interval_seconds <= 0:
-            interval_seconds = 3600
-
-        while not self.stop_event.is_set():
-            try:
-                self.create_backup()
-            except Exception as e:
-                self._log(f"Ошибка в процессе создания резервной копии: {e}")
-            # Обновляем время следующего запуска
-            self.next_backup_time = time.time() + interval_seconds
-            self._update_next_backup_label()
-            if self.stop_event.wait(interval_seconds):
-                break
-
     # --- Обновление отображения следующего запуска ---
     def _update_next_backup_label(self):
         if self.next_backup_time:
@@ -403,8 +4208,9 @@ class BackupApp:
             self.next_backup_label.config(text="не запланировано")
 
     def _update_next_backup_time(self):
-        interval_seconds = (self.interval_weeks * 7 * 24 + self.interval_hours) * 3600
-        self.next_backup_time = time.time() + interval_seconds
+        # При нескольких заданиях ближайший запуск выставляет планировщик
+        if not self.jobs:
+            self.next_backup_time = time.time() + self._interval_seconds()
         self._update_next_backup_label()
 
     def _update_status_loop(self):
@@ -417,118 +4223,114 @@ class BackupApp:
                 self.status_text.set("Статус: Резервное копирование выполняется...")
         elif not self.running:
             self.status_text.set("Статус: Ожидание запуска")
+        self._update_next_backup_label()
         self.root.after(1000, self._update_status_loop)
 
-    # --- Создание резервной копии ---
-    def create_backup(self):
-        date_folder = time.strftime("%Y%m%d")
-        backup_dir = os.path.join(self.target_dir, date_folder)
-        if not os.path.exists(backup_dir):
-            try:
-                os.makedirs(backup_dir)
-                self._log(f"Создан каталог для резервных копий: {backup_dir}")
-            except Exception as e:
-                self._log(f"Ошибка при создании каталога резервных копий: {e}")
-                self._show_notification(f"Ошибка при создании каталога: {e}")
-                return
-
-        archive_name = time.strftime("%H%M%S") + ".zip"
-        archive_path = os.path.join(backup_dir, archive_name)
+    # --- Восстановление ---
+    def restore_backup(self):
+        target_dir = self._entry_primary_target()
+        archive_path = filedialog.askopenfilename(initialdir=target_dir or None,
+                                                  filetypes=[("Архивы", "*.zip"), ("Снимки репозитория", "*.json")],
+                                                  title="Восстановить состояние на момент архива")
+        if not archive_path:
+            return
+        dest_dir = filedialog.askdirectory(title="Каталог для восстановления")
+        if not dest_dir:
+            return
+        if archive_path.endswith(".json"):
+            threading.Thread(target=self._restore_snapshot, args=(archive_path, dest_dir), daemon=True).start()
+        else:
+            threading.Thread(target=self._restore_chain, args=(archive_path, dest_dir), daemon=True).start()
 
-        try:
-            compression = ZIP_DEFLATED if self.compression_level > 0 else ZIP_STORED
-            with ZipFile(archive_path, 'w', compression,
-                         compresslevel=self.compression_level if compression == ZIP_DEFLATED else None) as zipf:
-                total_files = 0
-                processed_files = 0
-                all_files = 0
-
-                for source_dir in self.source_dirs:
-                    for foldername, subfolders, filenames in os.walk(source_dir):
-                        subfolders[:] = [d for d in subfolders if not self._is_excluded(d)]
-                        all_files += len(filenames)
-                all_files += len(self.source_files)
-
-                for source_dir in self.source_dirs:
-                    for foldername, subfolders, filenames in os.walk(source_dir):
-                        subfolders[:] = [d for d in subfolders if not self._is_excluded(d)]
-                        for filename in filenames:
-                            if self._is_excluded(filename):
-                                continue
-                            filepath = os.path.join(foldername, filename)
-                            try:
-                                relative_path = os.path.relpath(filepath, source_dir)
-                                source_dir_name = os.path.basename(os.path.normpath(source_dir))
-                                arcname = os.path.join(source_dir_name, relative_path)
-                                zipf.write(filepath, arcname)
-                                total_files += 1
-                                self._log(f"Добавлен в архив: {filepath}")
-                            except Exception as e:
-                                self._log(f"Ошибка при добавлении файла {filepath}: {e}")
-
-                            processed_files += 1
-                            self._update_progress(processed_files, all_files)
-
-                for filepath in self.source_files:
-                    if not os.path.isfile(filepath):
-                        self._log(f"Файл не найден и пропущен: {filepath}")
-                        continue
-                    filename = os.path.basename(filepath)
-                    if self._is_excluded(filename):
-                        self._log(f"Файл исключён по маске: {filepath}")
-                        continue
-                    try:
-                        arcname = os.path.join("files", filename)
-                        zipf.write(filepath, arcname)
-                        total_files += 1
-                        self._log(f"Добавлен в архив: {filepath}")
-                    except Exception as e:
-                        self._log(f"Ошибка при добавлении файла {filepath}: {e}")
+    def restore_single_file(self):
+        target_dir = self._entry_primary_target()
+        if not os.path.isdir(target_dir):
+            messagebox.showerror("Ошибка", "Каталог для резервных копий не выбран или не существует")
+            return
+        query = simpledialog.askstring("Поиск файла", "Путь в архиве (например, docs/report.txt) или имя файла:")
+        if not query:
+            return
+        dest_dir = filedialog.askdirectory(title="Каталог для восстановления")
+        if not dest_dir:
+            return
+        threading.Thread(target=self._restore_single_file, args=(target_dir, query.strip(), dest_dir),
+                         daemon=True).start()
 
-                    processed_files += 1
-                    self._update_progress(processed_files, all_files)
+    def export_snapshot(self):
+        target_dir = self._entry_primary_target()
+        snapshot_path = filedialog.askopenfilename(
+            initialdir=os.path.join(target_dir, REPOSITORY_DIR_NAME, "snapshots") if target_dir else None,
+            filetypes=[("Снимки репозитория", "*.json")], title="Снимок для экспорта")
+        if not snapshot_path:
+            return
+        zip_path = filedialog.asksaveasfilename(defaultextension=".zip", filetypes=[("Архивы", "*.zip")],
+                                                title="Экспорт снимка в zip")
+        if not zip_path:
+            return
+        threading.Thread(target=self._export_snapshot, args=(snapshot_path, zip_path), daemon=True).start()
 
-            self._log(f"Резервная копия создана: {archive_path} (файлов: {total_files})")
-            self._show_notification(f"Резервная копия создана: {archive_path} (файлов: {total_files})")
-        except Exception as e:
-            self._log(f"Ошибка при создании резервной копии: {e}")
-            self._show_notification(f"Ошибка при создании резервной копии: {e}")
-        finally:
+    def _poll_progress(self):
+        # Интерфейс сам опрашивает счётчики несколько раз в секунду, рабочий поток виджеты не трогает
+        progress = self.current_progress
+        if progress is None or progress.finished is not None:
             self.progress.set(0)
-            self.root.update_idletasks()
+            self.progress_text.set("")
+        else:
+            snap = progress.snapshot()
+            self.progress.set(snap["fraction"] * 100)
+            eta = _format_duration(snap["eta"]) if snap["eta"] is not None else "оценивается"
+            self.progress_text.set(f"Файлов: {snap['files_done']}, {snap['files_per_sec']:.0f} файл/с, "
+                                   f"{snap['mb_per_sec']:.1f} МБ/с, осталось: {eta}")
+        self.root.after(PROGRESS_POLL_MS, self._poll_progress)
 
-    def _update_progress(self, processed, total):
-        if total > 0:
-            progress = (processed / total) * 100
-            self.progress.set(progress)
-            self.root.update_idletasks()
+    def _on_verbosity_changed(self):
+        self.log_verbosity = "debug" if self.verbose_log_var.get() else "info"
 
-    def _is_excluded(self, name):
-        for pattern in self.exclude_patterns:
-            if fnmatch.fnmatch(name, pattern):
-                return True
-        return False
+    def _entry_targets(self):
+        # В поле можно указать несколько целей через ";", первая - основная
+        return [t.strip() for t in self.target_entry.get().split(";") if t.strip()]
 
-    def _log(self, message):
-        self.log_queue.put(message)
+    def _entry_primary_target(self):
+        targets = self._entry_targets()
+        return targets[0] if targets else self.target_dir
 
-    def _process_log_queue(self):
-        try:
-            while True:
-                message = self.log_queue.get_nowait()
-                timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-                full_message = f"[{timestamp}] {message}\n"
+    def _selected_backup_mode(self):
+        for mode, title in BACKUP_MODES.items():
+            if title == self.mode_combobox.get():
+                return mode
+        return "full"
+
+    def _selected_preflight_policy(self):
+        for policy, title in PREFLIGHT_POLICIES.items():
+            if title == self.preflight_combobox.get():
+                return policy
+        return "warn"
 
-                self.log_text.config(state=tk.NORMAL)
-                self.log_text.insert(tk.END, full_message)
-                self.log_text.see(tk.END)
-                self.log_text.config(state=tk.DISABLED)
+    def _write_log(self, message, level):
+        self.log_queue.put((time.strftime("%Y-%m-%d %H:%M:%S"), level, message))
 
-                logging.info(message)
-                print(full_message.strip())
+    def _process_log_queue(self):
+        # Сообщения выводятся пачкой за такт: одна вставка в виджет вместо вставки на каждую строку
+        lines = []
+        try:
+            while len(lines) < LOG_BATCH_SIZE:
+                timestamp, level, message = self.log_queue.get_nowait()
+                logging.log(level, message)
+                lines.append(f"[{timestamp}] {message}")
         except Empty:
             pass
-        self.root.after(100, self._process_log_queue)
+
+        if lines:
+            print("\n".join(lines))
+            self.log_text.config(state=tk.NORMAL)
+            self.log_text.insert(tk.END, "\n".join(lines[-LOG_WIDGET_MAX_LINES:]) + "\n")
+            line_count = int(self.log_text.index("end-1c").split(".")[0])
+            if line_count > LOG_WIDGET_MAX_LINES:
+                self.log_text.delete("1.0", f"{line_count - LOG_WIDGET_MAX_LINES}.0")
+            self.log_text.see(tk.END)
+            self.log_text.config(state=tk.DISABLED)
+        # Если очередь не опустела, следующий такт - сразу
+        self.root.after(100 if len(lines) < LOG_BATCH_SIZE else 10, self._process_log_queue)
 
     def save_log(self):
         log_content = self.log_text.get('1.0', tk.END)
@@ -546,67 +4348,331 @@ class BackupApp:
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Не удалось сохранить лог:\n{e}")
 
-    def _save_settings(self):
-        settings = {
-            "source_dirs": self.source_dirs,
-            "source_files": self.source_files,
-            "target_dir": self.target_dir,
-            "interval_hours": self.interval_hours,
-            "interval_weeks": self.interval_weeks,
-            "compression_level": self.compression_level,
-            "exclude_patterns": self.exclude_patterns,
-        }
-        # Резервное копирование файла настроек
+    def _load_settings(self):
+        if not self.load_settings():
+            return
+        self.update_sources_listbox()
+        self.target_entry.delete(0, tk.END)
+        self.target_entry.insert(0, "; ".join(self._target_dirs()))
+        self.hours_entry.delete(0, tk.END)
+        self.hours_entry.insert(0, str(self.interval_hours))
+        self.weeks_entry.delete(0, tk.END)
+        self.weeks_entry.insert(0, str(self.interval_weeks))
+        self.compression_entry.delete(0, tk.END)
+        self.compression_entry.insert(0, str(self.compression_level))
+        self.workers_entry.delete(0, tk.END)
+        self.workers_entry.insert(0, str(self.compression_workers))
+        for entry, value in ((self.retention_daily_entry, self.retention_daily),
+                             (self.retention_weekly_entry, self.retention_weekly),
+                             (self.retention_monthly_entry, self.retention_monthly),
+                             (self.read_limit_entry, self.read_limit_mbps),
+                             (self.watch_flush_entry, self.watch_flush_seconds)):
+            entry.delete(0, tk.END)
+            entry.insert(0, str(value))
+        self.low_priority_var.set(self.low_priority)
+        self.watch_changes_var.set(self.watch_changes)
+        self.verbose_log_var.set(self.log_verbosity == "debug")
+        self.exclude_entry.delete(0, tk.END)
+        self.exclude_entry.insert(0, ", ".join(self.exclude_patterns))
+        self.mode_combobox.set(BACKUP_MODES.get(self.backup_mode, BACKUP_MODES["full"]))
+        self.preflight_combobox.set(PREFLIGHT_POLICIES.get(self.preflight_policy, PREFLIGHT_POLICIES["warn"]))
+
+
+class ConsoleBackup(BackupEngine):
+    """Консольный режим: события выводятся в stdout текстом или строками JSON."""
+
+    def __init__(self, json_output=False):
+        BackupEngine.__init__(self)
+        self.json_output = json_output
+
+    def _emit(self, event, **fields):
+        if self.json_output:
+            fields.update(event=event, time=time.strftime("%Y-%m-%d %H:%M:%S"))
+            print(json.dumps(fields, ensure_ascii=False), flush=True)
+        elif event != "progress":
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {fields['message']}", flush=True)
+
+    def _write_log(self, message, level):
+        logging.log(level, message)
+        self._emit("log", message=message, level=logging.getLevelName(level).lower())
+
+    def _show_notification(self, message):
+        self._emit("notification", message=message)
+
+    def report_progress(self, stop):
+        # Отдельный поток раз в CONSOLE_PROGRESS_INTERVAL секунд выводит снимок счётчиков
+        reported = None
+        while not stop.wait(CONSOLE_PROGRESS_INTERVAL):
+            progress = self.current_progress
+            if progress is None or (progress is reported and progress.finished is not None):
+                continue
+            reported = progress
+            self._emit("progress", **progress.snapshot())
+
+
+# --- Самопроверка ограничения скорости ---
+def run_throttle_check(limit_mbps):
+    # Два потока читают временные файлы через один Throttle около THROTTLE_CHECK_SECONDS;
+    # достигнутая скорость должна отличаться от лимита не больше чем на THROTTLE_CHECK_TOLERANCE
+    throttle = Throttle(limit_mbps)
+    size = int(limit_mbps * 1024 * 1024 * THROTTLE_CHECK_SECONDS / 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f"read{i}.bin") for i in range(2)]
+        for path in paths:
+            with open(path, "wb") as f:
+                f.truncate(size)  # разреженный файл: скорость упирается в лимит, а не в диск
+        throttle.limiter = RateLimiter(throttle.limiter.rate)
+
+        def read(path):
+            with throttle.open(path) as f:
+                while f.read(COPY_BLOCK_SIZE):
+                    pass
+
+        threads = [threading.Thread(target=read, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    achieved = throttle.limiter.achieved_rate() / 1024 / 1024
+    deviation = achieved / limit_mbps - 1
+    ok = abs(deviation) <= THROTTLE_CHECK_TOLERANCE
+    print(f"Лимит {limit_mbps:g} МБ/с, достигнуто {achieved:.2f} МБ/с ({deviation * 100:+.1f}%): "
+          f"{'в пределах' if ok else 'вне'} допуска {THROTTLE_CHECK_TOLERANCE * 100:.0f}%")
+    return 0 if ok else 1
+
+
+# --- Замер производительности ---
+def _bench_file_path(root, index, depth, fanout):
+    # Файлы раскладываются по дереву глубины depth с fanout подкаталогами на уровне
+    parts = []
+    n = index
+    for _ in range(depth):
+        parts.append(f"d{n % fanout}")
+        n //= fanout
+    return os.path.join(root, *parts, f"f{index:06d}.dat")
+
+
+def _bench_data(rng, words, size, kind):
+    if kind == "random":
+        return rng.randbytes(size)
+    # Текст из случайного словаря сжимается примерно как исходники и логи
+    out = bytearray()
+    while len(out) < size:
+        out += (" ".join(rng.choices(words, k=1024)) + "\n").encode("ascii")
+    return bytes(out[:size])
+
+
+def _generate_bench_tree(root, name, spec, scale, seed):
+    # Одинаковые сценарий, масштаб и seed дают побайтно одинаковое дерево;
+    # уже созданное дерево с той же спецификацией используется повторно
+    marker = {"scenario": name, "spec": spec, "scale": scale, "seed": seed}
+    marker_path = os.path.join(root, BENCH_SPEC_FILE)
+    if os.path.isfile(marker_path):
         try:
-            if os.path.isfile(SETTINGS_FILE):
-                shutil.copy2(SETTINGS_FILE, SETTINGS_BACKUP_FILE)
-        except Exception as e:
-            self._log(f"Ошибка при создании резервной копии настроек: {e}")
+            with open(marker_path, "r", encoding="utf-8") as f:
+                if json.load(f) == marker:
+                    return False
+        except Exception:
+            pass
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    rng = random.Random(f"{seed}:{name}")
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(2000)]
+    for index in range(max(1, round(spec["files"] * scale))):
+        path = _bench_file_path(root, index, spec["depth"], spec["fanout"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        kind = spec["data"]
+        if kind == "mixed":
+            kind = "random" if index % 2 else "text"
+        remaining = rng.randint(spec["min_size"], spec["max_size"])
+        with open(path, "wb") as f:
+            while remaining > 0:
+                block = _bench_data(rng, words, min(remaining, COPY_BLOCK_SIZE), kind)
+                f.write(block)
+                remaining -= len(block)
+    _write_json_atomic(marker_path, marker)
+    return True
+
+
+def _run_bench_child(settings_path, workdir):
+    # Каждый сценарий - отдельный процесс, чтобы пиковая память не копилась между сценариями
+    cmd = [sys.executable, os.path.abspath(__file__), "--once", "--settings", settings_path]
+    with open(os.path.join(workdir, "benchmark.log"), "a", encoding="utf-8") as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=workdir)
+        if not hasattr(os, "wait4"):
+            return proc.wait(), None
+        _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss в Linux - в килобайтах, в macOS - в байтах
+    peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return proc.returncode, peak_rss
+
+
+def run_benchmark(args):
+    workdir = os.path.abspath(args.benchmark)
+    os.makedirs(workdir, exist_ok=True)
+    names = [n.strip() for n in args.bench_scenarios.split(",")] if args.bench_scenarios else list(BENCH_SCENARIOS)
+    unknown = [n for n in names if n not in BENCH_SCENARIOS]
+    if unknown:
+        print(f"Неизвестные сценарии: {', '.join(unknown)} (есть: {', '.join(BENCH_SCENARIOS)})")
+        return 2
 
+    # Сжатие, потоки и проверка берутся из файла настроек, если он есть: замеряется рабочая конфигурация
+    base = BackupEngine()
+    base.load_settings(args.settings)
+    results = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "script_sha256": _file_digest(os.path.abspath(__file__)),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.bench_scale,
+        "seed": BENCH_SEED,
+        "settings": {"compression_level": base.compression_level, "compression_workers": base.compression_workers,
+                     "codec_rules": base.codec_rules, "hash_files": base.hash_files,
+                     "verify_backups": base.verify_backups, "staging_patterns": base.staging_patterns},
+        "scenarios": {},
+    }
+    failed = False
+    for name in names:
+        source = os.path.join(workdir, "src-" + name)
+        target = os.path.join(workdir, "target-" + name)
+        started = time.monotonic()
+        if _generate_bench_tree(source, name, BENCH_SCENARIOS[name], args.bench_scale, BENCH_SEED):
+            print(f"{name}: дерево создано за {time.monotonic() - started:.1f} с")
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target)
+
+        engine = BackupEngine()
+        engine.load_settings(args.settings)
+        engine.source_dirs, engine.source_files = [source], []
+        engine.target_dir, engine.mirror_dirs = target, []
+        engine.exclude_patterns = [BENCH_SPEC_FILE]
+        engine.backup_mode = "full"
+        engine.retention_daily = engine.retention_weekly = engine.retention_monthly = 0
+        engine.read_limit_mbps, engine.throttle_schedule = 0, []
+        engine.watch_changes = False
+        engine.scrub_interval_hours = 0
+        # Замеры не должны попадать в метрики рабочих заданий, а оценка перед запуском - в их время
+        engine.metrics_dir = ""
+        engine.preflight_policy = "off"
+        engine.jobs = []
+        settings_path = os.path.join(workdir, f"settings-{name}.json")
+        engine.save_settings(settings_path, settings_path + ".bak")
+
+        started = time.monotonic()
+        returncode, peak_rss = _run_bench_child(settings_path, workdir)
+        wall = time.monotonic() - started
+        last_run = {}
         try:
-            with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
-                json.dump(settings, f, ensure_ascii=False, indent=2)
-            self._log("Настройки сохранены")
+            with open(os.path.join(target, STATE_DIR_NAME, LAST_RUN_FILE), "r", encoding="utf-8") as f:
+                last_run = json.load(f)
         except Exception as e:
-            self._log(f"Ошибка при сохранении настроек: {e}")
+            print(f"{name}: итоги запуска не прочитаны: {e}")
+        files, size = last_run.get("files", 0), last_run.get("bytes", 0)
+        # Скорость - по времени самого запуска: запуск интерпретатора, импорт и чтение настроек
+        # в дочернем процессе не должны скрывать изменения в create_backup
+        run = last_run.get("phases", {}).get("total") or wall
+        result = {
+            "returncode": returncode,
+            "files": files,
+            "bytes": size,
+            "archive_bytes": sum(os.path.getsize(a) for a in _list_archives(target)),
+            "run_seconds": round(run, 3),
+            "wall_seconds": round(wall, 3),
+            "files_per_sec": round(files / run, 1) if run > 0 else 0,
+            "mb_per_sec": round(size / run / 1024 / 1024, 2) if run > 0 else 0,
+            "peak_rss_mb": round(peak_rss / 1024 / 1024, 1) if peak_rss else None,
+            "phases": last_run.get("phases", {}),
+        }
+        results["scenarios"][name] = result
+        failed = failed or returncode != 0 or not last_run
+        phases = ", ".join(f"{k} {v:.2f}" for k, v in result["phases"].items())
+        print(f"{name}: файлов {files}, {size / 1024 / 1024:.1f} МБ за {run:.2f} с (процесс {wall:.2f} с) - "
+              f"{result['files_per_sec']} файлов/с, {result['mb_per_sec']} МБ/с, "
+              f"память {result['peak_rss_mb']} МБ; фазы, с: {phases}")
 
-    def _load_settings(self):
-        if os.path.isfile(SETTINGS_FILE):
-            try:
-                with open(SETTINGS_FILE, "r", encoding="utf-8") as f:
-                    settings = json.load(f)
-                self.source_dirs = settings.get("source_dirs", [])
-                self.source_files = settings.get("source_files", [])
-                self.target_dir = settings.get("target_dir", "")
-                self.interval_hours = settings.get("interval_hours", 1)
-                self.interval_weeks = settings.get("interval_weeks", 0)
-                self.compression_level = settings.get("compression_level", 6)
-                self.exclude_patterns = settings.get("exclude_patterns", [])
+    output = args.bench_output or os.path.join(workdir, time.strftime("benchmark-%Y%m%d-%H%M%S.json"))
+    _write_json_atomic(output, results)
+    print(f"Результаты: {output}")
 
-                self.update_sources_listbox()
-                self.target_entry.delete(0, tk.END)
-                self.target_entry.insert(0, self.target_dir)
-                self.hours_entry.delete(0, tk.END)
-                self.hours_entry.insert(0, str(self.interval_hours))
-                self.weeks_entry.delete(0, tk.END)
-                self.weeks_entry.insert(0, str(self.interval_weeks))
-                self.compression_entry.delete(0, tk.END)
-                self.compression_entry.insert(0, str(self.compression_level))
-                self.exclude_entry.delete(0, tk.END)
-                self.exclude_entry.insert(0, ", ".join(self.exclude_patterns))
-
-                self._log("Настройки загружены")
-            except Exception as e:
-                self._log(f"Ошибка при загрузке настроек: {e}")
+    if args.bench_compare:
+        with open(args.bench_compare, "r", encoding="utf-8") as f:
+            previous = json.load(f).get("scenarios", {})
+        for name, result in results["scenarios"].items():
+            old = previous.get(name)
+            if not old:
+                continue
+            deltas = []
+            for key in ("files_per_sec", "mb_per_sec", "peak_rss_mb"):
+                if old.get(key) and result.get(key) is not None:
+                    deltas.append(f"{key} {(result[key] / old[key] - 1) * 100:+.1f}%")
+            print(f"{name} относительно {args.bench_compare}: {', '.join(deltas)}")
+    return 1 if failed else 0
 
 
-if __name__ == "__main__":
+def run_console(args):
+    engine = ConsoleBackup(json_output=args.json)
+    if not engine.load_settings(args.settings):
+        engine._log(f"Файл настроек не найден или повреждён: {args.settings}")
+        return 2
+    if args.verbose:
+        engine.log_verbosity = "debug"
+
+    # Остановка по сигналу от менеджера служб
+    def on_signal(signum, frame):
+        engine._log("Получен сигнал остановки")
+        engine.stop_event.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    if args.restore:
+        source, dest_dir = args.restore
+        if source.endswith(".json"):
+            engine._restore_snapshot(source, dest_dir)
+        elif os.path.isdir(source):
+            engine._restore_link_snapshot(source, dest_dir)
+        else:
+            engine._restore_chain(source, dest_dir)
+        return 0
+    if args.restore_file:
+        target_dir, query, dest_dir = args.restore_file
+        return 0 if engine._restore_single_file(target_dir, query, dest_dir) else 1
+    if args.scrub:
+        return 1 if engine.scrub_archives() else 0
+    if args.estimate:
+        engine.log_estimate(engine.estimate_run())
+        return 0
+
+    error = engine.check_paths()
+    if error:
+        engine._log(error.replace("\n", " "))
+        return 2
+    stop_reporting = threading.Event()
+    if args.json:
+        threading.Thread(target=engine.report_progress, args=(stop_reporting,), daemon=True).start()
+    try:
+        if args.once:
+            engine.run_once()
+        else:
+            engine._log("Резервное копирование по расписанию запущено")
+            engine.run_backup_schedule()
+    finally:
+        stop_reporting.set()
+    if args.json and engine.current_progress is not None:
+        engine._emit("progress", **engine.current_progress.snapshot())
+    return 0
+
+
+def run_gui():
+    _import_ui_modules()
     root = tk.Tk()
     style = ttk.Style(root)
     style.theme_use('clam')
     root.minsize(700, 500)
 
-    app = BackupApp(root)
+    BackupApp(root)
 
     def on_deiconify(event):
         root.overrideredirect(True)
@@ -614,3 +4680,43 @@ if __name__ == "__main__":
     root.bind("<Map>", on_deiconify)
 
     root.mainloop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File backup: без параметров открывается окно программы")
+    parser.add_argument("--once", action="store_true", help="выполнить одно резервное копирование и выйти")
+    parser.add_argument("--daemon", action="store_true", help="работать без интерфейса по расписанию из настроек")
+    parser.add_argument("--restore", nargs=2, metavar=("АРХИВ", "КАТАЛОГ"),
+                        help="восстановить цепочку до архива .zip, снимок .json или каталог снимка в каталог")
+    parser.add_argument("--restore-file", nargs=3, metavar=("ЦЕЛЬ", "ФАЙЛ", "КАТАЛОГ"),
+                        help="восстановить последнюю версию файла из каталога архивов цели "
+                             "(путь в архиве или имя файла) в каталог")
+    parser.add_argument("--estimate", action="store_true",
+                        help="оценить размер и длительность следующего запуска и выйти")
+    parser.add_argument("--scrub", action="store_true",
+                        help="перепроверить все архивы целей (код возврата 1 - найдены повреждённые)")
+    parser.add_argument("--check-throttle", type=float, metavar="МБ/С",
+                        help="проверить, что чтение через ограничитель держит заданную скорость (код возврата 1 - нет)")
+    parser.add_argument("--benchmark", metavar="КАТАЛОГ",
+                        help="замер производительности на синтетических деревьях в рабочем каталоге")
+    parser.add_argument("--bench-scale", type=float, default=1.0,
+                        help="множитель числа файлов в сценариях (по умолчанию %(default)s)")
+    parser.add_argument("--bench-scenarios", help="сценарии через запятую: " + ", ".join(BENCH_SCENARIOS))
+    parser.add_argument("--bench-output", help="файл результатов JSON (по умолчанию в рабочем каталоге)")
+    parser.add_argument("--bench-compare", metavar="JSON", help="сравнить с результатами прошлого замера")
+    parser.add_argument("--settings", default=SETTINGS_FILE, help="файл настроек (по умолчанию %(default)s)")
+    parser.add_argument("--json", action="store_true", help="события и ход работы в формате JSON Lines")
+    parser.add_argument("--verbose", action="store_true", help="писать в лог каждый обработанный файл")
+    args = parser.parse_args()
+
+    if args.check_throttle:
+        sys.exit(run_throttle_check(args.check_throttle))
+    if args.benchmark:
+        sys.exit(run_benchmark(args))
+    if args.once or args.daemon or args.restore or args.restore_file or args.scrub or args.estimate:
+        sys.exit(run_console(args))
+    run_gui()
+
+
+if __name__ == "__main__":
+    main()
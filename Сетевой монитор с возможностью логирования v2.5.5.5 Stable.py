@@ -3,6 +3,7 @@ from tkinter import messagebox, ttk
 import subprocess
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import platform
 import os
 from datetime import datetime
@@ -40,6 +41,15 @@ class NetworkMonitor:
 
         self.lock = threading.Lock()
 
+        # Параллельный опрос устройств: пул потоков по числу устройств (не больше max_ping_workers)
+        # и таймаут одного пинга (сек)
+        self.ping_timeout = 2
+        self.max_ping_workers = 512
+        self.ping_executor = None
+        self.ping_workers = 0
+        # Будит поток опроса, чтобы новое устройство получило статус без ожидания конца паузы
+        self.wake_event = threading.Event()
+
         self.frame = tk.Frame(root)
         self.frame.pack(pady=10)
 
@@ -166,13 +176,10 @@ class NetworkMonitor:
             remove_button = ttk.Button(device_frame, text="Удалить", command=lambda: self.confirm_remove_device(info, ip, device_frame), style="Glass.TButton")
             remove_button.grid(row=0, column=4, padx=5, sticky="w")
 
-            initial_status = "Online" if self.ping_device(ip) else "Offline"
+            # Начальный статус неизвестен: его определит и запишет в лог ближайший опрос
             with self.lock:
-                self.devices[ip] = (device_frame, device_label, time_label, info, interval_combobox, expected_state_combobox, time.time(), initial_status, False)
-
-            # Логирование начального состояния
-            if self.logging_combobox.get() == "Вкл":
-                self.log_device_status(info, ip, initial_status)
+                self.devices[ip] = (device_frame, device_label, time_label, info, interval_combobox, expected_state_combobox, time.time(), None, False)
+            self.wake_event.set()
 
             for entry in self.ip_entries:
                 entry.delete(0, tk.END)
@@ -201,27 +208,52 @@ class NetworkMonitor:
                 frame.grid(row=i + 1, column=0, sticky="w", pady=5)
 
     def ping_device(self, ip):
-        param = "-n" if platform.system().lower() == "windows" else "-c"
-        command = ["ping", param, "1", ip]
+        system = platform.system().lower()
+        # Таймаут ожидания ответа: Windows - в миллисекундах, macOS - общий в секундах, Linux - в секундах
+        if system == "windows":
+            command = ["ping", "-n", "1", "-w", str(self.ping_timeout * 1000), ip]
+        elif system == "darwin":
+            command = ["ping", "-c", "1", "-t", str(self.ping_timeout), ip]
+        else:
+            command = ["ping", "-c", "1", "-W", str(self.ping_timeout), ip]
         try:
-            if platform.system().lower() == "windows":
-                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
+            # Запасной таймаут на случай зависания самого процесса ping
+            if system == "windows":
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, creationflags=subprocess.CREATE_NO_WINDOW, timeout=self.ping_timeout + 1)
             else:
-                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=self.ping_timeout + 1)
             output = result.stdout
-            if platform.system().lower() == "windows":
+            if system == "windows":
                 return "TTL=" in output
             else:
                 return "1 packets transmitted, 1 received" in output
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
             return False
 
+    def ping_devices(self, ips):
+        # Все устройства опрашиваются одновременно, цикл длится примерно как самый медленный пинг.
+        # Пул пересоздаётся, когда устройств стало больше, чем в нём потоков
+        workers = min(max(len(ips), 1), self.max_ping_workers)
+        if self.ping_executor is None or workers > self.ping_workers:
+            old_executor = self.ping_executor
+            self.ping_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ping")
+            self.ping_workers = workers
+            if old_executor is not None:
+                old_executor.shutdown(wait=False)
+        return dict(zip(ips, self.ping_executor.map(self.ping_device, ips)))
+
     def update_status(self):
         while True:
+            self.wake_event.clear()
             with self.lock:
                 devices_copy = self.devices.copy()
+            results = self.ping_devices(list(devices_copy))
             for ip, (frame, device_label, time_label, info, interval_combobox, expected_state_combobox, start_time, last_status, notified) in devices_copy.items():
-                current_status = "Online" if self.ping_device(ip) else "Offline"
+                with self.lock:
+                    # Устройство могли удалить, пока шёл опрос
+                    if ip not in self.devices:
+                        continue
+                current_status = "Online" if results[ip] else "Offline"
                 if current_status != last_status:
                     start_time = time.time()
                     notified = False
@@ -249,7 +281,7 @@ class NetworkMonitor:
                         with self.lock:
                             self.devices[ip] = (
                             frame, device_label, time_label, info, interval_combobox, expected_state_combobox, start_time, current_status, notified)
-            time.sleep(3)
+            self.wake_event.wait(3)
 
     def update_device_label(self, label, info, ip, bg):
         if label.winfo_exists():
@@ -330,13 +362,9 @@ class NetworkMonitor:
                         remove_button = ttk.Button(device_frame, text="Удалить", command=lambda ip=ip, frame=device_frame, info=info: self.confirm_remove_device(info, ip, frame), style="Glass.TButton")
                         remove_button.grid(row=0, column=4, padx=25, sticky="w")
 
-                        initial_status = "Online" if self.ping_device(ip) else "Offline"
+                        # Начальный статус определит первый опрос - сразу для всех устройств
                         with self.lock:
-                            self.devices[ip] = (device_frame, device_label, time_label, info, interval_combobox, expected_state_combobox, time.time(), initial_status, False)
-
-                        # Логирование начального состояния
-                        if self.logging_combobox.get() == "Вкл":
-                            self.log_device_status(info, ip, initial_status)
+                            self.devices[ip] = (device_frame, device_label, time_label, info, interval_combobox, expected_state_combobox, time.time(), None, False)
                     else:
                         print(f"Некорректная строка: {line.strip()}")
 
@@ -506,6 +534,8 @@ class NetworkMonitor:
         # Сохранение устройств и состояния логирования перед закрытием
         self.save_devices()
         self.save_logging_state()
+        if self.ping_executor is not None:
+            self.ping_executor.shutdown(wait=False, cancel_futures=True)
         self.root.destroy()
 
 if __name__ == "__main__":